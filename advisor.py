@@ -0,0 +1,119 @@
+#  -*- coding: utf-8 -*-
+"""Suggesting indexes for a query from its EXPLAIN QUERY PLAN"""
+import re
+import sqlite3
+from engine import quote_identifier
+
+# "SEARCH s USING AUTOMATIC COVERING INDEX (cust=? AND region>?)"
+_AUTOMATIC_INDEX = re.compile(r"USING AUTOMATIC (?:PARTIAL )?(?:COVERING )?INDEX \((.+)\)")
+_INDEX_USED = re.compile(r"^SEARCH .+? USING (?:COVERING )?INDEX (\S+) \(")
+_TERM = re.compile(r"^(.+?)(?:=|>|<|>=|<=)\?$")
+
+
+def query_plan(conn, sql):
+    """Returns the EXPLAIN QUERY PLAN rows of a query as (id, parent, detail)"""
+    return [(row[0], row[1], row[3]) for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+
+
+def _automatic_index_columns(detail):
+    """Returns the columns of an automatic index SQLite builds on every run, or None"""
+    match = _AUTOMATIC_INDEX.search(detail)
+    if not match:
+        return None
+    columns = []
+    for term in match.group(1).split(" AND "):
+        column = _TERM.match(term.strip())
+        if column:
+            columns.append(column.group(1))
+    return columns
+
+
+def _shadow_schema(conn):
+    """Returns a connection to empty copies of the schemas of conn, with their tables, indexes and views
+
+    Each schema is copied into a shared in-memory database of its own, attached under the same name,
+    so queries on attached workbooks like jan.Sales compile too. Closing the connections in the
+    returned list frees the copies.
+    """
+    shadow = sqlite3.connect(":memory:")
+    connections = [shadow]
+    for _, name, _ in conn.execute("PRAGMA database_list").fetchall():
+        if name == "temp":
+            continue
+        if name == "main":
+            target = shadow
+        else:
+            uri = f"file:excel_sql_shadow_{id(shadow)}_{len(connections)}?mode=memory&cache=shared"
+            target = sqlite3.connect(uri, uri=True)
+            connections.append(target)
+            shadow.execute(f"ATTACH DATABASE ? AS {quote_identifier(name)}", (uri,))
+        schema = conn.execute(f"SELECT sql FROM {quote_identifier(name)}.sqlite_master WHERE type IN ('table', 'index', 'view') "
+                              "AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type = 'view'").fetchall()
+        for (statement,) in schema:
+            target.execute(statement)
+    return shadow, connections
+
+
+def suggest_indexes(conn, sql, tables, schemas=("main",)):
+    """Returns [(table, columns)] indexes that would replace scans or automatic indexes in the query plan
+
+    Candidate indexes are tried on an empty copy of the schema, SQLite's planner then picks the ones
+    it would use without any of the real data being indexed. Only tables of the given schemas get
+    candidates, the tables of other attached databases are read but never indexed.
+    """
+    shadow, connections = _shadow_schema(conn)
+    try:
+        columns_of = {(schema, table): [row[1] for row in shadow.execute(f"SELECT * FROM {quote_identifier(schema)}.pragma_table_info(?)", (table,))]
+                      for schema in schemas for table in tables}
+
+        plan = query_plan(shadow, sql)
+        if not any(detail.startswith("SCAN ") or "AUTOMATIC" in detail for _, _, detail in plan):
+            return []
+
+        # Columns the query reads, the authorizer reports real table names rather than aliases or views
+        candidates = set()
+
+        def authorizer(action, table, column, database, source):
+            if action == sqlite3.SQLITE_READ and (database, table) in columns_of and column:
+                candidates.add((database, table, (column,)))
+            return sqlite3.SQLITE_OK
+
+        shadow.set_authorizer(authorizer)
+        shadow.execute(f"EXPLAIN {sql}").fetchall()
+        shadow.set_authorizer(None)
+
+        # Automatic indexes name their columns but only the table alias, try every table that has them
+        for _, _, detail in plan:
+            automatic = _automatic_index_columns(detail)
+            if automatic:
+                for (schema, table), table_columns in columns_of.items():
+                    if all(column in table_columns for column in automatic):
+                        candidates.add((schema, table, tuple(automatic)))
+                        candidates.update((schema, table, (column,)) for column in automatic)
+
+        names = {}
+        for number, (schema, table, columns) in enumerate(sorted(candidates)):
+            names[f"candidate_{number}"] = (table, list(columns))
+            shadow.execute(f"CREATE INDEX {quote_identifier(schema)}.candidate_{number} ON {quote_identifier(table)} "
+                           f"({', '.join(map(quote_identifier, columns))})")
+
+        suggestions = []
+        for _, _, detail in query_plan(shadow, sql):
+            used = _INDEX_USED.match(detail)
+            if used and used.group(1) in names and names[used.group(1)] not in suggestions:
+                suggestions.append(names[used.group(1)])
+        return suggestions
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def advise(workbook, sql):
+    """Parses the sheets a query reads and returns the indexes suggested for it"""
+    with workbook.lock:
+        workbook.ensure_sheets(workbook.referenced_sheets(sql))
+        existing = {(table, tuple(columns)) for _, table, columns in workbook.indexes()}
+        # The workbook can be attached to itself, its sheets are indexed whichever schema name the query uses
+        schemas = ("main", *(alias for alias, attached in workbook.attached.items() if attached is workbook))
+        return [(table, columns) for table, columns in suggest_indexes(workbook.conn, sql, workbook.sheets, schemas)
+                if (table, tuple(columns)) not in existing]
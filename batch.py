@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+"""Running saved queries against workbooks without the GUI
+
+    python batch.py --input jan.xlsx feb.xlsx --query totals.txt top10.txt --output-dir reports
+
+Every workbook is loaded once and all queries run against that load, workbooks are processed in
+parallel. Outputs are named <workbook>_<query>.<format>, nothing runs if two of them would get the
+same name. The exit status is 1 if any query failed.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+from cache import ResultCache, WorkbookCache
+from engine import DEFAULT_WORKERS, INGEST_MODES, Workbook
+from writers import OUTPUT_FORMATS, write_result
+
+
+def run_workbook(input_file, jobs, ingest=INGEST_MODES[0], use_result_cache=True, cache_dir=None):
+    """Loads a workbook once and runs every (sql, output_file) job against it
+
+    Returns [(output_file, rows, error)], error is None for queries that succeeded.
+    """
+    result_cache = ResultCache(cache_dir) if use_result_cache else None
+    # Nested worker pools aren't possible here, the workbooks themselves are spread over processes
+    workbook = Workbook(input_file, WorkbookCache(cache_dir), workers=1, ingest=ingest)
+    try:
+        workbook.load()
+    except Exception as e:
+        return [(output_file, None, f"Failed to load {input_file}: {e}") for _, output_file in jobs]
+
+    results = []
+    try:
+        for sql, output_file in jobs:
+            try:
+                key = workbook.result_key(sql, output_file) if result_cache else None
+                rows = result_cache.fetch(key, output_file) if key else None
+                if rows is None:
+                    rows = workbook.run(sql, lambda cursor: write_result(cursor, output_file))
+                    if key:
+                        result_cache.store(key, output_file, rows)
+                results.append((output_file, rows, None))
+            except Exception as e:
+                results.append((output_file, None, str(e)))
+    finally:
+        workbook.close()
+    return results
+
+
+def _run_workbook_task(args):
+    """Worker process entry point for run_batch"""
+    input_file, jobs, options = args
+    return input_file, run_workbook(input_file, jobs, **options)
+
+
+def run_batch(input_files, query_files, output_dir=None, output_format="xlsx", processes=DEFAULT_WORKERS, on_result=None, **options):
+    """Runs every query file against every input file, returns [(input_file, output_file, rows, error)]
+
+    Raises ValueError before running anything if two of the outputs would have the same name.
+    """
+    queries = []
+    for query_file in query_files:
+        with open(query_file, 'r') as file:
+            queries.append((os.path.splitext(os.path.basename(query_file))[0], file.read()))
+
+    tasks = []
+    outputs = {}  # output file: workbook and query writing it, two of them would overwrite each other
+    for input_file in dict.fromkeys(os.path.abspath(input_file) for input_file in input_files):  # each workbook once
+        directory = output_dir or os.path.dirname(input_file)
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        jobs = []
+        for query_name, sql in queries:
+            output_file = os.path.join(directory, f"{name}_{query_name}.{output_format}")
+            key = os.path.normcase(os.path.abspath(output_file))
+            if key in outputs:
+                raise ValueError(f"{outputs[key]} and {input_file} with {query_name} would both write {output_file}")
+            outputs[key] = f"{input_file} with {query_name}"
+            jobs.append((sql, output_file))
+        tasks.append((input_file, jobs, options))
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    results = []
+    with multiprocessing.Pool(max(1, min(processes, len(tasks)))) as pool:
+        for input_file, workbook_results in pool.imap_unordered(_run_workbook_task, tasks):
+            for output_file, rows, error in workbook_results:
+                results.append((input_file, output_file, rows, error))
+                if on_result:
+                    on_result(input_file, output_file, rows, error)
+    return results
+
+
+def _print_result(input_file, output_file, rows, error):
+    """Prints one line per finished query"""
+    if error is None:
+        print(f"OK      {output_file} ({rows} rows)")
+    else:
+        print(f"FAILED  {output_file}: {error}", file=sys.stderr)
+
+
+def main(argv=None):
+    """Command line entry point, returns the exit status"""
+    parser = argparse.ArgumentParser(description="Run saved SQL queries against Excel workbooks without the GUI.")
+    parser.add_argument("-i", "--input", nargs="+", required=True, help="Excel workbooks to query")
+    parser.add_argument("-q", "--query", nargs="+", required=True, help="query files (.txt) to run against every workbook")
+    parser.add_argument("-o", "--output-dir", help="directory for the outputs, defaults to each workbook's directory")
+    parser.add_argument("-f", "--format", default="xlsx", choices=[extension.lstrip(".") for extension in OUTPUT_FORMATS], help="output format")
+    parser.add_argument("-p", "--processes", type=int, default=DEFAULT_WORKERS, help="workbooks processed in parallel")
+    parser.add_argument("--ingest", default=INGEST_MODES[0], choices=INGEST_MODES, help="how sheets are read")
+    parser.add_argument("--no-result-cache", action="store_true", help="always run queries, even if a cached result exists")
+    args = parser.parse_args(argv)
+
+    try:
+        results = run_batch(args.input, args.query, args.output_dir, args.format, args.processes, on_result=_print_result,
+                            ingest=args.ingest, use_result_cache=not args.no_result_cache)
+    except ValueError as e:
+        parser.error(str(e))
+
+    failed = sum(1 for *_, error in results if error is not None)
+    print(f"{len(results) - failed} of {len(results)} queries succeeded")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,257 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+"""Benchmarking each stage of loading, querying and writing on generated workbooks
+
+    python benchmark.py --sheets 3 --rows 50000 --columns 8 --output results.json
+    python benchmark.py --rows 50000 --baseline baseline.json --threshold 0.2 --threshold parse=0.5
+
+Three pipelines are timed stage by stage: "pandas" is the original pd.ExcelFile / to_sql / to_excel /
+openpyxl formatting path, "bulk" parses with pandas like the engine does and bulk inserts into typed
+tables instead of to_sql, "stream" is the engine's openpyxl streaming ingest and streaming writer.
+Ingest stages also report rows per second. Every pipeline runs in a fresh process, so its peak memory
+isn't measured on top of what the pipelines before it left behind. Results are written as JSON,
+comparing against a baseline exits with status 1 on regressions.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import pandas as pd
+import openpyxl
+from openpyxl.worksheet.table import Table, TableStyleInfo
+from engine import bulk_store_sheet, create_cache_db, parse_sheet, stream_sheet
+from telemetry import MemorySampler
+from writers import write_xlsx
+
+DTYPES = ("int", "float", "str", "date")
+DEFAULT_QUERY = "SELECT a.*, b.c1 AS other FROM Sheet1 a JOIN Sheet1 b ON a.c0 = b.c0 WHERE a.c0 % 3 = 0"
+DEFAULT_THRESHOLD = 0.2
+
+
+def generate_workbook(path, sheets=3, rows=10000, columns=8, dtypes=DTYPES, seed=0):
+    """Writes a workbook of random data, column i of every sheet has dtype dtypes[i % len(dtypes)]"""
+    rng = random.Random(seed)
+    words = [f"item {i}" for i in range(200)]  # repeated strings, like codes and names in real exports
+    start = datetime.datetime(2020, 1, 1)
+    values = {
+        "int": lambda row: row if rng.random() > 0.01 else None,
+        "float": lambda row: round(rng.uniform(0, 10000), 2),
+        "str": lambda row: rng.choice(words),
+        "date": lambda row: start + datetime.timedelta(days=rng.randrange(2000)),
+    }
+    kinds = [dtypes[i % len(dtypes)] for i in range(columns)]
+    kinds[0] = "int"  # c0 is the join key of the default query
+
+    wb = openpyxl.Workbook(write_only=True)
+    for number in range(1, sheets + 1):
+        ws = wb.create_sheet(f"Sheet{number}")
+        ws.append([f"c{i}" for i in range(columns)])
+        for row in range(rows):
+            ws.append([row % (rows // 2 or 1) if i == 0 else values[kind](row) for i, kind in enumerate(kinds)])
+    wb.save(path)
+
+
+class Stages:
+    """Times stages and records their peak memory"""
+
+    def __init__(self):
+        self.results = {}
+
+
+    def run(self, name, function, *args):
+        with MemorySampler() as memory:
+            start = time.perf_counter()
+            result = function(*args)
+            seconds = time.perf_counter() - start
+        self.results[name] = {"seconds": round(seconds, 4), "peak_rss_mb": round(memory.peak / 1024 ** 2, 1)}
+        return result
+
+
+    def add_rows(self, name, rows):
+        """Records the rows a stage processed and its rows per second"""
+        stage = self.results[name]
+        stage["rows"] = rows
+        stage["rows_per_second"] = round(rows / stage["seconds"]) if stage["seconds"] else None
+
+
+def benchmark_pandas(input_file, output_file, query):
+    """Times the original pipeline: parse with pandas, to_sql, read_sql_query, to_excel, openpyxl formatting"""
+    stages = Stages()
+
+    def parse():
+        with pd.ExcelFile(input_file) as xls:
+            return {sheet: pd.read_excel(xls, sheet_name=sheet) for sheet in xls.sheet_names}
+    frames = stages.run("parse", parse)
+
+    conn = sqlite3.connect(":memory:")
+    stages.run("ingest", lambda: [df.to_sql(sheet, conn, if_exists="replace", index=False) for sheet, df in frames.items()])
+    stages.add_rows("ingest", sum(len(df) for df in frames.values()))
+    result_df = stages.run("query", pd.read_sql_query, query, conn)
+    conn.close()
+    stages.run("write", lambda: result_df.to_excel(output_file, index=False, sheet_name="SQLResults"))
+
+    def format_table():
+        wb = openpyxl.load_workbook(output_file)
+        ws = wb["SQLResults"]
+        table = Table(displayName="SQLTable", ref=ws.dimensions)
+        table.tableStyleInfo = TableStyleInfo(name="TableStyleMedium2", showRowStripes=True)
+        ws.add_table(table)
+        for column in ws.columns:
+            ws.column_dimensions[column[0].column_letter].width = max(len(str(cell.value)) for cell in column) + 2
+        wb.save(output_file)
+        wb.close()
+    stages.run("format", format_table)
+    return stages.results
+
+
+def benchmark_stream(input_file, output_file, query):
+    """Times the engine pipeline: header load, streaming ingest, query streamed into the output"""
+    stages = Stages()
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, "benchmark.sqlite")
+    sheet_names = []
+
+    stages.run("load", create_cache_db, input_file, db_path, sheet_names.extend)
+    conn = sqlite3.connect(db_path)
+
+    def ingest():
+        for sheet in sheet_names:
+            stream_sheet(conn, input_file, sheet)
+        conn.commit()
+    stages.run("ingest", ingest)
+    stages.add_rows("ingest", conn.total_changes)  # rows inserted, the connection was opened for the ingest
+    stages.run("query_write", lambda: write_xlsx(conn.execute(query), output_file))
+    conn.close()
+    os.remove(db_path)
+    os.rmdir(directory)
+    return stages.results
+
+
+def benchmark_bulk(input_file, output_file, query):
+    """Times the engine's pandas path: parse into compact columns, bulk insert into typed tables, query streamed into the output"""
+    stages = Stages()
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, "benchmark.sqlite")
+    sheet_names = []
+
+    stages.run("load", create_cache_db, input_file, db_path, sheet_names.extend)
+    parsed = stages.run("parse", lambda: {sheet: parse_sheet(input_file, sheet) for sheet in sheet_names})
+    conn = sqlite3.connect(db_path)
+
+    def ingest():
+        for sheet, (columns, arrays) in parsed.items():
+            bulk_store_sheet(conn, sheet, columns, arrays)
+        conn.commit()
+    stages.run("ingest", ingest)
+    stages.add_rows("ingest", sum(len(arrays[0]) for columns, arrays in parsed.values() if arrays))
+    stages.run("query_write", lambda: write_xlsx(conn.execute(query), output_file))
+    conn.close()
+    os.remove(db_path)
+    os.rmdir(directory)
+    return stages.results
+
+
+PIPELINES = {
+    "pandas": benchmark_pandas,
+    "bulk": benchmark_bulk,
+    "stream": benchmark_stream,
+}
+
+
+def run_pipeline(pipeline, input_file, output_file, query):
+    """Runs a pipeline in a process of its own and returns its stage results"""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(PIPELINES[pipeline], (input_file, output_file, query))
+
+
+def compare(results, baseline, thresholds):
+    """Returns a list of regressions of results against baseline, thresholds are per stage or "default" """
+    regressions = []
+    for pipeline, stages in results["pipelines"].items():
+        for stage, measured in stages.items():
+            reference = baseline.get("pipelines", {}).get(pipeline, {}).get(stage)
+            if not reference:
+                continue
+            threshold = thresholds.get(stage, thresholds["default"])
+            for metric in ("seconds", "peak_rss_mb"):
+                if reference[metric] and measured[metric] > reference[metric] * (1 + threshold):
+                    change = measured[metric] / reference[metric] - 1
+                    regressions.append(f"{pipeline}.{stage}.{metric}: {reference[metric]} -> {measured[metric]} (+{change:.0%}, allowed +{threshold:.0%})")
+    return regressions
+
+
+def _parse_threshold(value, thresholds):
+    """Parses --threshold 0.2 or --threshold stage=0.5"""
+    stage, _, number = value.rpartition("=")
+    thresholds[stage or "default"] = float(number)
+
+
+def main(argv=None):
+    """Command line entry point, returns the exit status"""
+    parser = argparse.ArgumentParser(description="Benchmark the Excel SQL pipeline stage by stage on a generated workbook.")
+    parser.add_argument("--sheets", type=int, default=3, help="sheets in the generated workbook")
+    parser.add_argument("--rows", type=int, default=10000, help="rows per sheet")
+    parser.add_argument("--columns", type=int, default=8, help="columns per sheet")
+    parser.add_argument("--dtypes", default=",".join(DTYPES), help=f"column types, cycled over the columns (from {', '.join(DTYPES)})")
+    parser.add_argument("--query", default=DEFAULT_QUERY, help="query to benchmark")
+    parser.add_argument("--pipelines", default=",".join(PIPELINES), help="pipelines to run")
+    parser.add_argument("--workbook", help="benchmark this workbook instead of generating one")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--threshold", action="append", default=[], help="allowed slowdown as a fraction, either for all stages or as stage=fraction")
+    args = parser.parse_args(argv)
+
+    dtypes = tuple(dtype.strip() for dtype in args.dtypes.split(","))
+    if not set(dtypes) <= set(DTYPES):
+        parser.error(f"--dtypes must be from {', '.join(DTYPES)}")
+    thresholds = {"default": DEFAULT_THRESHOLD}
+    for value in args.threshold:
+        _parse_threshold(value, thresholds)
+
+    directory = tempfile.mkdtemp()
+    input_file = args.workbook or os.path.join(directory, "benchmark.xlsx")
+    if not args.workbook:
+        print(f"Generating {args.sheets} sheets x {args.rows} rows x {args.columns} columns...")
+        generate_workbook(input_file, args.sheets, args.rows, args.columns, dtypes)
+
+    results = {
+        "config": {"sheets": args.sheets, "rows": args.rows, "columns": args.columns, "dtypes": list(dtypes),
+                   "query": args.query, "workbook": args.workbook, "python": sys.version.split()[0],
+                   "pandas": pd.__version__, "openpyxl": openpyxl.__version__, "sqlite": sqlite3.sqlite_version},
+        "pipelines": {},
+    }
+    for pipeline in args.pipelines.split(","):
+        output_file = os.path.join(directory, f"{pipeline}_output.xlsx")
+        results["pipelines"][pipeline] = run_pipeline(pipeline, input_file, output_file, args.query)
+        os.remove(output_file)
+        for stage, measured in results["pipelines"][pipeline].items():
+            rate = f" {measured['rows_per_second']:>10,} rows/s" if measured.get("rows_per_second") else ""
+            print(f"{pipeline:8} {stage:12} {measured['seconds']:9.3f}s {measured['peak_rss_mb']:9.1f} MB{rate}")
+
+    if not args.workbook:
+        os.remove(input_file)
+    os.rmdir(directory)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), thresholds)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,380 @@
+#  -*- coding: utf-8 -*-
+"""On-disk cache of parsed workbooks, keyed by file fingerprint"""
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import zipfile
+from collections import Counter
+import xml.etree.ElementTree as ET
+
+CACHE_SIZE_LIMIT = 2 * 1024 ** 3  # 2 GB
+RESULT_CACHE_SIZE_LIMIT = 1024 ** 3  # 1 GB
+HASH_CHUNK_SIZE = 1024 * 1024
+SHEETS_TABLE = "_excel_sql_sheets"
+SHARED_STRINGS_PART = "xl/sharedStrings.xml"
+STYLES_PART = "xl/styles.xml"
+SCAN_CHUNK_SIZE = 1024 * 1024
+
+# String literals and quoted identifiers, or runs of comments and whitespace, for normalize_sql
+_SQL_TOKENS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])|(?:\s|--[^\n]*|/\*.*?(?:\*/|$))+""", re.S)
+# A shared string cell of a sheet's XML, <c r="A2" t="s"><v>12</v></c>
+_SHARED_STRING_CELL = re.compile(rb'<c\b[^>]*\bt="s"[^>]*>\s*<v>(\d+)</v>')
+# Queries whose result changes between runs on the same data: random values, the current time ('now', CURRENT_DATE,
+# time functions without a time value like date() or strftime('%s')) and counts of changes
+_VOLATILE_SQL = re.compile(r"""\brandom(?:blob)?\s*\(|'now'|\bcurrent_(?:date|time|timestamp)\b
+                               |\b(?:date|time|datetime|julianday|unixepoch)\s*\(\s*\)|\bstrftime\s*\(\s*'(?:[^']|'')*'\s*\)
+                               |\b(?:total_)?changes\s*\(|\blast_insert_rowid\s*\(""", re.I | re.X)
+
+
+def default_cache_dir():
+    """Returns the per-user directory the workbook cache lives in"""
+    if os.name == 'nt':
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+        return os.path.join(base, "ExcelSQLGUI", "cache")
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "excel_sql_gui")
+
+
+def hash_file(path):
+    """Returns a content hash of the file at path"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(path, with_hash=True):
+    """Returns path, size, mtime and (optionally) content hash of a file"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return {
+        "path": path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "hash": hash_file(path) if with_hash else None,
+    }
+
+
+def workbook_parts(path):
+    """Returns ({sheet name: XML part}, {part: fingerprint}) of an xlsx file, None for files that aren't xlsx zips
+
+    A part's fingerprint is the CRC and size it has in the zip directory, so no sheet data has to be read.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            parts = {info.filename: info for info in archive.infolist()}
+            workbook = ET.fromstring(archive.read("xl/workbook.xml"))
+            relationships = ET.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    except (OSError, zipfile.BadZipFile, KeyError, ET.ParseError):
+        return None
+
+    targets = {element.get("Id"): element.get("Target") for element in relationships if element.tag.endswith("}Relationship")}
+    sheets = {}
+    for element in workbook.iter():
+        if element.tag.endswith("}sheet"):
+            relationship = next((value for key, value in element.attrib.items() if key.endswith("}id")), None)
+            target = targets.get(relationship) or ""
+            sheets[element.get("name")] = target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+    return sheets, {name: f"{info.CRC:08x}{info.file_size:x}" for name, info in parts.items()}
+
+
+def sheet_fingerprints(path):
+    """Returns {sheet name: fingerprint} of an xlsx file, None for files that aren't xlsx zips
+
+    A sheet's fingerprint combines its XML part's with the shared strings and styles every sheet depends on.
+    """
+    parts = workbook_parts(path)
+    if parts is None:
+        return None
+    sheets, fingerprints = parts
+    common = fingerprints.get(SHARED_STRINGS_PART, "-") + fingerprints.get(STYLES_PART, "-")
+    return {sheet: fingerprints.get(part, "-") + common for sheet, part in sheets.items()}
+
+
+def shared_strings(path):
+    """Returns the shared strings table of an xlsx file as a list, empty if it has none"""
+    strings = []
+    try:
+        with zipfile.ZipFile(path) as archive:
+            if SHARED_STRINGS_PART not in archive.namelist():
+                return strings
+            with archive.open(SHARED_STRINGS_PART) as file:
+                for _, element in ET.iterparse(file):
+                    if element.tag.endswith("}si"):
+                        # Plain strings have one <t>, rich text one per run <r>, phonetic hints <rPh> aren't text
+                        texts = [child for child in element if child.tag.endswith("}t")]
+                        texts += [text for run in element if run.tag.endswith("}r") for text in run if text.tag.endswith("}t")]
+                        strings.append("".join(text.text or "" for text in texts))
+                        element.clear()
+    except (OSError, zipfile.BadZipFile, ET.ParseError):
+        pass
+    return strings
+
+
+def shared_string_indices(path, part):
+    """Returns the indices into the shared strings table a sheet's XML part uses, read in chunks"""
+    indices = set()
+    with zipfile.ZipFile(path) as archive, archive.open(part) as file:
+        rest = b""
+        while True:
+            chunk = file.read(SCAN_CHUNK_SIZE)
+            data = rest + chunk
+            # Keep everything after the last complete cell for the next chunk
+            end = data.rfind(b"</c>") + 4 if chunk else len(data)
+            indices.update(int(index) for index in _SHARED_STRING_CELL.findall(data, 0, end))
+            rest = data[end:]
+            if not chunk:
+                return indices
+
+
+def normalize_sql(sql):
+    """Returns the query without comments and with whitespace collapsed, literals are left untouched"""
+    return _SQL_TOKENS.sub(lambda match: match.group(1) or " ", sql).strip().rstrip(";").strip()
+
+
+def is_volatile(sql):
+    """Checks whether a query can return something else on the same data, like random(), 'now' or CURRENT_DATE"""
+    return bool(_VOLATILE_SQL.search(sql))
+
+
+def _evict(conn, table, key_column, path_of, size_limit, keep=()):
+    """Removes least recently used entries of a cache index until it fits the size limit, except the keys in keep"""
+    rows = conn.execute(f"SELECT {key_column}, bytes FROM {table} ORDER BY last_used").fetchall()
+    total = sum(size for _, size in rows)
+
+    for key, size in rows:
+        if total <= size_limit:
+            break
+        if key in keep:
+            continue
+        try:
+            if os.path.exists(path_of(key)):
+                os.remove(path_of(key))
+        except OSError:
+            continue  # still open somewhere, try again next time
+        conn.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (key,))
+        total -= size
+
+
+class WorkbookCache:
+    """SQLite databases of parsed workbooks, evicted least recently used first"""
+
+    def __init__(self, cache_dir=None, size_limit=CACHE_SIZE_LIMIT):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.size_limit = size_limit
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.index_path = os.path.join(self.cache_dir, "index.sqlite")
+        self.in_use = Counter()  # hashes of the databases open in this process, they are never evicted
+        self.lock = threading.Lock()
+
+        with self._index() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                hash TEXT PRIMARY KEY,
+                                path TEXT,
+                                size INTEGER,
+                                mtime REAL,
+                                db_file TEXT,
+                                bytes INTEGER,
+                                last_used REAL)""")
+
+
+    def _index(self):
+        """Opens the cache index, used as a context manager to commit changes"""
+        return sqlite3.connect(self.index_path, timeout=30)
+
+
+    def _db_path(self, file_hash):
+        """Path of the cache database for a content hash"""
+        return os.path.join(self.cache_dir, f"{file_hash}.sqlite")
+
+
+    def lookup(self, path):
+        """Returns (cache database path or None, fingerprint) for a workbook"""
+        fingerprint = file_fingerprint(path, with_hash=False)
+
+        with self._index() as conn:
+            # Unchanged path, size and mtime: skip hashing the whole file
+            row = conn.execute("SELECT hash FROM entries WHERE path = ? AND size = ? AND mtime = ?",
+                               (fingerprint["path"], fingerprint["size"], fingerprint["mtime"])).fetchone()
+            if row and os.path.exists(self._db_path(row[0])):
+                fingerprint["hash"] = row[0]
+                conn.execute("UPDATE entries SET last_used = ? WHERE hash = ?", (time.time(), row[0]))
+                return self._db_path(row[0]), fingerprint
+
+        # Moved, copied or touched file: match by content
+        fingerprint["hash"] = hash_file(fingerprint["path"])
+        with self._index() as conn:
+            row = conn.execute("SELECT hash FROM entries WHERE hash = ?", (fingerprint["hash"],)).fetchone()
+            if row and os.path.exists(self._db_path(row[0])):
+                conn.execute("UPDATE entries SET path = ?, size = ?, mtime = ?, last_used = ? WHERE hash = ?",
+                             (fingerprint["path"], fingerprint["size"], fingerprint["mtime"], time.time(), row[0]))
+                return self._db_path(row[0]), fingerprint
+
+        return None, fingerprint
+
+
+    def build_path(self, fingerprint):
+        """Returns a fresh temporary database path to build a cache entry into"""
+        tmp_path = f"{self._db_path(fingerprint['hash'])}.{os.getpid()}.tmp"  # batch runs build in several processes
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return tmp_path
+
+
+    def store(self, fingerprint, tmp_path):
+        """Moves a finished build into the cache and evicts old entries if over the size limit"""
+        db_path = self._db_path(fingerprint["hash"])
+        if os.path.exists(db_path):
+            os.remove(tmp_path)  # another process stored the same workbook first
+        else:
+            os.replace(tmp_path, db_path)
+
+        with self._index() as conn:
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (fingerprint["hash"], fingerprint["path"], fingerprint["size"], fingerprint["mtime"],
+                          os.path.basename(db_path), os.path.getsize(db_path), time.time()))
+
+        self.evict(keep=fingerprint["hash"])
+        return db_path
+
+
+    def update_size(self, fingerprint):
+        """Records the new size of an entry that grew after it was stored"""
+        db_path = self._db_path(fingerprint["hash"])
+        with self._index() as conn:
+            conn.execute("UPDATE entries SET bytes = ?, last_used = ? WHERE hash = ?",
+                         (os.path.getsize(db_path), time.time(), fingerprint["hash"]))
+        self.evict(keep=fingerprint["hash"])
+
+
+    def hold(self, fingerprint):
+        """Marks an entry's database as open, so it isn't evicted until it is released"""
+        with self.lock:
+            self.in_use[fingerprint["hash"]] += 1
+
+
+    def release(self, fingerprint):
+        """Marks an entry's database as closed again"""
+        with self.lock:
+            self.in_use[fingerprint["hash"]] -= 1
+            if self.in_use[fingerprint["hash"]] <= 0:
+                del self.in_use[fingerprint["hash"]]
+
+
+    def evict(self, keep=None):
+        """Removes least recently used entries until the cache fits the size limit, except keep and the open ones"""
+        with self.lock:
+            keep = {keep, *self.in_use}
+        with self._index() as conn:
+            _evict(conn, "entries", "hash", self._db_path, self.size_limit, keep)
+
+
+    def rekey(self, old, new):
+        """Moves an entry to the fingerprint of a newer version of its workbook, for updating it in place"""
+        db_path = self._db_path(new["hash"])
+        os.replace(self._db_path(old["hash"]), db_path)
+        with self._index() as conn:
+            conn.execute("DELETE FROM entries WHERE hash = ?", (old["hash"],))
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (new["hash"], new["path"], new["size"], new["mtime"],
+                          os.path.basename(db_path), os.path.getsize(db_path), time.time()))
+        return db_path
+
+
+    def invalidate(self, path):
+        """Drops every cache entry for a workbook so the next load rebuilds it"""
+        path = os.path.abspath(path)
+        hashes = set()
+        with self._index() as conn:
+            hashes.update(row[0] for row in conn.execute("SELECT hash FROM entries WHERE path = ?", (path,)))
+        if os.path.exists(path):
+            hashes.add(hash_file(path))
+
+        with self._index() as conn:
+            for file_hash in hashes:
+                try:
+                    if os.path.exists(self._db_path(file_hash)):
+                        os.remove(self._db_path(file_hash))
+                except OSError:
+                    pass
+                conn.execute("DELETE FROM entries WHERE hash = ?", (file_hash,))
+
+
+class ResultCache:
+    """Output files of earlier queries keyed by query and data, evicted least recently used first"""
+
+    def __init__(self, cache_dir=None, size_limit=RESULT_CACHE_SIZE_LIMIT):
+        self.cache_dir = os.path.join(cache_dir or default_cache_dir(), "results")
+        self.size_limit = size_limit
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.index_path = os.path.join(self.cache_dir, "index.sqlite")
+
+        with self._index() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                                key TEXT PRIMARY KEY,
+                                file TEXT,
+                                rows INTEGER,
+                                bytes INTEGER,
+                                last_used REAL)""")
+
+
+    def _index(self):
+        """Opens the cache index, used as a context manager to commit changes"""
+        return sqlite3.connect(self.index_path, timeout=30)
+
+
+    def _file_path(self, key):
+        """Path of the stored output for a key, the extension is part of the key"""
+        with self._index() as conn:
+            row = conn.execute("SELECT file FROM results WHERE key = ?", (key,)).fetchone()
+        return os.path.join(self.cache_dir, row[0]) if row else os.path.join(self.cache_dir, key)
+
+
+    def fetch(self, key, output_file):
+        """Copies a stored result to output_file, returns its row count or None if there is none"""
+        with self._index() as conn:
+            row = conn.execute("SELECT file, rows FROM results WHERE key = ?", (key,)).fetchone()
+            if not row or not os.path.exists(os.path.join(self.cache_dir, row[0])):
+                return None
+            conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        tmp_path = f"{output_file}.part"
+        shutil.copyfile(os.path.join(self.cache_dir, row[0]), tmp_path)
+        os.replace(tmp_path, output_file)
+        return row[1]
+
+
+    def store(self, key, output_file, rows):
+        """Keeps a copy of a finished output file for later runs of the same query"""
+        file = key + os.path.splitext(output_file)[1].lower()
+        size = os.path.getsize(output_file)
+        if size > self.size_limit:
+            return
+
+        shutil.copyfile(output_file, os.path.join(self.cache_dir, file))
+        with self._index() as conn:
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", (key, file, rows, size, time.time()))
+            _evict(conn, "results", "key", self._file_path, self.size_limit, keep={key})
+
+
+    @staticmethod
+    def key(sql, sheet_fingerprints, *options):
+        """Returns the cache key for a query's output on sheets with the given fingerprints"""
+        parts = [normalize_sql(sql), *options] + [f"{sheet}={fingerprint}" for sheet, fingerprint in sorted(sheet_fingerprints.items())]
+        return hashlib.blake2b("\x00".join(parts).encode(), digest_size=20).hexdigest()
+
+
+def read_sheets(db_path):
+    """Returns {sheet name: [columns]} in workbook order from a cache database"""
+    conn = sqlite3.connect(db_path)
+    try:
+        sheets = [row[0] for row in conn.execute(f"SELECT name FROM {SHEETS_TABLE} ORDER BY position")]
+        return {sheet: [row[1] for row in conn.execute("SELECT * FROM pragma_table_info(?)", (sheet,))]
+                for sheet in sheets}
+    finally:
+        conn.close()
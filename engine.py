@@ -0,0 +1,1267 @@
+#  -*- coding: utf-8 -*-
+"""Loading workbooks into SQLite and running queries against them, independent of the GUI"""
+import csv
+import datetime
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import multiprocessing
+import threading
+import weakref
+import zlib
+from collections import OrderedDict
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from itertools import islice, repeat, zip_longest
+from urllib.request import pathname2url
+import numpy as np
+import pandas as pd
+import openpyxl
+from cache import (SHARED_STRINGS_PART, SHEETS_TABLE, STYLES_PART, ResultCache, file_fingerprint, is_volatile, normalize_sql, read_sheets,
+                   shared_string_indices, shared_strings, sheet_fingerprints, workbook_parts)
+
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+# stream reads .xlsx and .csv rows with openpyxl and csv, other files are parsed with pandas and bulk inserted.
+# bulk always parses with pandas and pandas writes with DataFrame.to_sql, both mostly for comparing them.
+INGEST_MODES = ("stream", "bulk", "pandas")
+STREAM_BATCH_SIZE = 10000
+STREAMABLE_EXTENSIONS = (".xlsx", ".xlsm", ".csv")
+CSV_EXTENSIONS = (".csv",)
+CSV_SAMPLE_SIZE = 64 * 1024
+
+# Cell values sqlite3 stores as they are, everything else goes through _sql_value
+_PLAIN_TYPES = (type(None), int, float, str)
+
+# Indexes created through the index advisor, restored whenever their sheet is parsed again
+INDEXES_TABLE = "_excel_sql_indexes"
+
+# Zip part fingerprints of the file a cache database was built from, to find the sheets that changed on reload
+PARTS_TABLE = "_excel_sql_parts"
+
+# SQLite VM steps between checks for a cancelled query
+PROGRESS_INTERVAL = 1000
+
+# Names a statement of a script, -- name: Totals
+_STATEMENT_NAME = re.compile(r"^\s*--\s*name\s*:\s*(.+?)\s*$", re.M | re.I)
+# A string literal, or a name in double quotes, brackets, backticks or without quotes, for sql_names
+_SQL_NAME = re.compile(r"""'(?:[^']|'')*'|"((?:[^"]|"")*)"|\[([^\]]*)\]|`([^`]*)`|(\w+)""")
+
+# Rows per page a ResultPager reads at once, and how many pages it keeps
+PAGE_SIZE = 200
+PAGE_CACHE_SIZE = 50
+
+
+class QueryCancelled(Exception):
+    """Raised when a running query is cancelled"""
+
+
+class ScriptError(Exception):
+    """Raised when a query of a script fails, the message starts with the query's name"""
+
+
+def quote_identifier(name):
+    """Quotes a table or column name for use in SQL"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def is_streamable(input_file):
+    """Checks whether the file can be streamed row by row, older .xls files need pandas"""
+    return input_file.lower().endswith(STREAMABLE_EXTENSIONS)
+
+
+def is_csv(input_file):
+    """Checks whether the file is a CSV file, which is loaded as a single sheet"""
+    return input_file.lower().endswith(CSV_EXTENSIONS)
+
+
+def csv_sheet_name(input_file):
+    """Returns the sheet name of a CSV file, its file name like in Excel"""
+    return os.path.splitext(os.path.basename(input_file))[0]
+
+
+def sql_name(name):
+    """Returns a name usable in SQL without quotes, "Sales 2024-Q1" becomes Sales_2024_Q1, "" if nothing is left"""
+    name = re.sub(r"\W+", "_", name).strip("_")
+    if name[:1].isdigit():
+        name = f"_{name}"
+    return name
+
+
+def sql_names(sql):
+    """Returns the lowercase names a query mentions, quoted or not, leaving out string literals and comments"""
+    names = set()
+    for match in _SQL_NAME.finditer(normalize_sql(sql)):
+        name = next((group for group in match.groups() if group is not None), None)
+        if name is not None:
+            names.add(name.replace('""', '"').lower())
+    return names
+
+
+def schema_alias(path, taken=()):
+    """Returns a schema name for attaching a file, jan.xlsx becomes jan, names in taken get a number"""
+    alias = sql_name(os.path.splitext(os.path.basename(path))[0]) or "file"
+    taken = {name.lower() for name in taken} | {"main", "temp", "scratch"}  # scratch is used while parsing
+    base, number = alias, 2
+    while alias.lower() in taken:
+        alias = f"{base}_{number}"
+        number += 1
+    return alias
+
+
+def _csv_format(input_file):
+    """Detects the encoding and delimiter of a CSV file from its start, Excel writes ; in some locales"""
+    with open(input_file, 'rb') as file:
+        sample = file.read(CSV_SAMPLE_SIZE)
+    try:
+        encoding = "utf-8-sig"
+        text = sample.decode(encoding)
+    except UnicodeDecodeError as e:
+        if e.start < len(sample) - 3:  # not just a character cut off at the end of the sample
+            encoding = "cp1252"
+        text = sample.decode(encoding, errors="ignore")
+    try:
+        return encoding, csv.Sniffer().sniff(text, delimiters=",;\t|")
+    except csv.Error:
+        return encoding, csv.excel
+
+
+def _csv_value(value):
+    """Converts a CSV field to a number if it is one and empty fields to NULL, like pandas does"""
+    if value == "":
+        return None
+    if len(value) > 1 and value[0] == "0" and value[1].isdigit():
+        return value  # codes like 007 keep their leading zeros
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _csv_column(column):
+    """Converts a CSV column read as text with _csv_value, like streamed rows, columns of only numbers become numeric"""
+    values = column.map(_csv_value)
+    if any(isinstance(value, str) for value in values):
+        return values
+    return pd.to_numeric(values)
+
+
+def header_names(values):
+    """Turns a header row into column names the same way pandas does"""
+    values = list(values)
+    while values and values[-1] is None:
+        values.pop()
+
+    names = []
+    seen = {}
+    for i, value in enumerate(values):
+        name = f"Unnamed: {i}" if value is None else str(value)
+        if name in seen:
+            # Duplicate headers become "name.1", "name.2", ...
+            base = name
+            while name in seen:
+                seen[base] += 1
+                name = f"{base}.{seen[base]}"
+        seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _header_and_rows(ws):
+    """Returns the column names from the first non-blank row of a read-only worksheet and an iterator over the rows below"""
+    ws.reset_dimensions()  # don't trust the stored sheet size, some exporters get it wrong
+    rows = ws.iter_rows(values_only=True)
+    for row in rows:
+        if any(value is not None for value in row):
+            return header_names(row), rows
+    return None, rows
+
+
+@contextmanager
+def _sheet_rows(input_file, sheet):
+    """Yields the column names and an iterator over the rows below them, streamed from an xlsx or CSV file"""
+    if is_csv(input_file):
+        encoding, dialect = _csv_format(input_file)
+        with open(input_file, newline='', encoding=encoding) as file:
+            reader = csv.reader(file, dialect)
+            # The header stays text, "01" is a column name and not the number 1
+            header = next((row for row in reader if any(row)), None)
+            yield (header_names(value or None for value in header) if header else None,
+                   (tuple(map(_csv_value, row)) for row in reader))
+        return
+
+    wb = openpyxl.load_workbook(input_file, read_only=True, data_only=True)
+    try:
+        yield _header_and_rows(wb[sheet])
+    finally:
+        wb.close()
+
+
+def read_headers(input_file):
+    """Returns the sheet names and a generator of (sheet, columns) that only reads the header rows"""
+    if is_csv(input_file):
+        sheet = csv_sheet_name(input_file)
+
+        def headers():
+            with _sheet_rows(input_file, sheet) as (columns, _):
+                yield sheet, columns or []
+        return [sheet], headers()
+
+    if not is_streamable(input_file):
+        xls = pd.ExcelFile(input_file)
+
+        def headers():
+            with xls:
+                for sheet in xls.sheet_names:
+                    yield sheet, [str(column) for column in pd.read_excel(xls, sheet_name=sheet, nrows=0).columns]
+        return xls.sheet_names, headers()
+
+    wb = openpyxl.load_workbook(input_file, read_only=True, data_only=True)
+
+    def headers():
+        try:
+            for sheet in wb.sheetnames:
+                yield sheet, _header_and_rows(wb[sheet])[0] or []
+        finally:
+            wb.close()
+    return wb.sheetnames, headers()
+
+
+def create_cache_db(input_file, db_path, on_sheet_names=None, on_sheet=None):
+    """Creates a database with an empty table per sheet, reading only sheet names and headers"""
+    conn = sqlite3.connect(db_path)
+    try:
+        sheet_names, headers = read_headers(input_file)
+        if on_sheet_names:
+            on_sheet_names(sheet_names)
+
+        conn.execute(f"CREATE TABLE {SHEETS_TABLE} (position INTEGER, name TEXT, ingested INTEGER)")
+        for position, (sheet, columns) in enumerate(headers):
+            if columns:  # SQLite can't hold tables without columns
+                conn.execute(f"CREATE TABLE {quote_identifier(sheet)} ({', '.join(map(quote_identifier, columns))})")
+            conn.execute(f"INSERT INTO {SHEETS_TABLE} VALUES (?, ?, 0)", (position, sheet))
+            if on_sheet:
+                on_sheet(sheet)
+        create_sheet_views(conn, sheet_names)
+        store_parts(conn, input_file)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def create_sheet_views(conn, sheets):
+    """Creates a view named like Sales_2024 for every sheet that needs quotes, like "Sales 2024"
+
+    Names another sheet already has are skipped. The views stay valid when a sheet's table is
+    replaced on parsing, SQLite resolves them by name.
+    """
+    taken = {sheet.lower() for sheet in sheets}
+    for sheet in sheets:
+        alias = sql_name(sheet)
+        if alias and alias != sheet and alias.lower() not in taken:
+            taken.add(alias.lower())
+            conn.execute(f"CREATE VIEW IF NOT EXISTS {quote_identifier(alias)} AS SELECT * FROM {quote_identifier(sheet)}")
+
+
+def store_parts(conn, input_file):
+    """Records the part fingerprints of an xlsx file and its shared strings, which changed_sheets compares against"""
+    parts = workbook_parts(input_file)
+    conn.execute(f"DROP TABLE IF EXISTS {PARTS_TABLE}")
+    if parts is None:
+        return
+    sheets, fingerprints = parts
+    conn.execute(f"CREATE TABLE {PARTS_TABLE} (name TEXT PRIMARY KEY, fingerprint TEXT, data BLOB)")
+    # Sheet names can't contain "/", so they don't clash with the part names
+    conn.executemany(f"INSERT INTO {PARTS_TABLE} VALUES (?, ?, NULL)", [(sheet, fingerprints.get(part)) for sheet, part in sheets.items()])
+    conn.execute(f"INSERT INTO {PARTS_TABLE} VALUES (?, ?, NULL)", (STYLES_PART, fingerprints.get(STYLES_PART)))
+    conn.execute(f"INSERT INTO {PARTS_TABLE} VALUES (?, ?, ?)", (SHARED_STRINGS_PART, fingerprints.get(SHARED_STRINGS_PART),
+                                                                  zlib.compress(json.dumps(shared_strings(input_file)).encode())))
+
+
+def changed_sheets(conn, input_file):
+    """Returns the sheets of a new version of an xlsx file that differ from the one conn was built from
+
+    None if the sheets can't be compared, then the whole file has to be loaded again. A sheet whose
+    XML part is unchanged still changed if a shared string it uses changed, as strings are stored
+    once per workbook and only referenced by index from the sheets.
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (PARTS_TABLE,)).fetchone():
+        return None  # built before part fingerprints were recorded
+    parts = workbook_parts(input_file)
+    if parts is None:
+        return None
+    sheets, fingerprints = parts
+    old = {name: (fingerprint, data) for name, fingerprint, data in conn.execute(f"SELECT name, fingerprint, data FROM {PARTS_TABLE}")}
+
+    # Styles hold the number formats that make a number a date
+    if old.get(STYLES_PART, (None,))[0] != fingerprints.get(STYLES_PART):
+        return set(sheets)
+
+    changed = {sheet for sheet, part in sheets.items() if sheet not in old or old[sheet][0] != fingerprints.get(part)}
+    old_strings_fingerprint, old_strings = old.get(SHARED_STRINGS_PART, (None, None))
+    if old_strings_fingerprint != fingerprints.get(SHARED_STRINGS_PART):
+        old_strings = json.loads(zlib.decompress(old_strings)) if old_strings else []
+        new_strings = shared_strings(input_file)
+        differing = {i for i in range(max(len(old_strings), len(new_strings)))
+                     if i >= len(old_strings) or i >= len(new_strings) or old_strings[i] != new_strings[i]}
+        if differing:
+            changed.update(sheet for sheet, part in sheets.items()
+                           if sheet not in changed and not differing.isdisjoint(shared_string_indices(input_file, part)))
+    return changed
+
+
+def parse_sheet(input_file, sheet):
+    """Parses all rows of a sheet into column names and column arrays, cheap to send between processes"""
+    if is_csv(input_file):
+        encoding, dialect = _csv_format(input_file)
+        # Read as text and converted like streamed rows, so codes like 007 are text in every ingest mode
+        df = pd.read_csv(input_file, sep=dialect.delimiter, encoding=encoding, dtype=str, keep_default_na=False).apply(_csv_column)
+    else:
+        df = pd.read_excel(input_file, sheet_name=sheet)
+    return [str(column) for column in df.columns], [compact_column(df.iloc[:, i]) for i in range(len(df.columns))]
+
+
+def compact_column(column):
+    """Returns a parsed column as its most compact array
+
+    Whole numbers with empty cells, which pandas reads as floats, become nullable integers stored as
+    INTEGER, dates without a time become DATE and text repeating a lot becomes categorical.
+    """
+    if pd.api.types.is_float_dtype(column):
+        values = column.dropna()
+        if len(values) and (values % 1 == 0).all() and values.abs().max() < 2 ** 53:
+            return pd.to_numeric(column.astype("Int64"), downcast="integer").array
+    elif pd.api.types.is_integer_dtype(column):
+        return pd.to_numeric(column, downcast="integer").to_numpy()
+    elif pd.api.types.is_datetime64_any_dtype(column):
+        values = column.dropna()
+        if len(values) and (values.dt.normalize() == values).all():
+            return column.dt.date.astype(object).where(column.notna(), None).to_numpy()
+    elif column.dtype == object and pd.api.types.infer_dtype(column, skipna=True) == "string":
+        if column.nunique() <= len(column) // 2:
+            return pd.Categorical(column)
+    return column.to_numpy()
+
+
+def store_sheet(conn, sheet, columns, arrays):
+    """Writes parsed column arrays into a sheet's table, replacing the empty placeholder"""
+    if columns:
+        df = pd.DataFrame(dict(enumerate(arrays)))
+        df.columns = columns
+        df.to_sql(sheet, conn, if_exists="replace", index=False)
+    else:
+        conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(sheet)}")
+    return columns
+
+
+# Column types of parsed columns by pandas.api.types.infer_dtype, everything else is TEXT
+_ARRAY_TYPES = {
+    "integer": "INTEGER",
+    "boolean": "INTEGER",
+    "floating": "REAL",
+    "mixed-integer-float": "REAL",
+    "decimal": "REAL",
+    "datetime64": "TIMESTAMP",
+    "datetime": "TIMESTAMP",
+    "date": "DATE",
+    "empty": "",
+}
+
+
+def _sql_values(array):
+    """Converts a parsed column to a list of values sqlite3 stores directly, with None for empty cells"""
+    if pd.api.types.is_datetime64_any_dtype(array):
+        dates = np.asarray(array, dtype="datetime64[us]")
+        seconds = dates.astype("datetime64[s]")
+        text = np.datetime_as_string(seconds, unit="s")
+        # Microseconds only where there are any, like datetime.isoformat
+        fractions = (dates != seconds) & ~np.isnat(dates)
+        if fractions.any():
+            text = np.where(fractions, np.datetime_as_string(dates, unit="us"), text)
+        return [None if value == "NaT" else value.replace("T", " ") for value in text.tolist()]
+    if isinstance(array, np.ndarray) and array.dtype.kind in "iu":
+        return array.tolist()
+    if isinstance(array, np.ndarray) and array.dtype.kind == "b":
+        return array.astype(int).tolist()
+    values = pd.Series(array).astype(object)
+    return [value if type(value) in _PLAIN_TYPES else _sql_value(value) for value in values.where(values.notna(), None)]
+
+
+def bulk_store_sheet(conn, sheet, columns, arrays, batch_size=STREAM_BATCH_SIZE):
+    """Writes parsed column arrays into a sheet's table with typed columns and batched executemany, replacing the placeholder
+
+    Does what store_sheet does without DataFrame.to_sql, which builds its statements and converts
+    its values row by row. The caller commits, so the whole sheet is one transaction.
+    """
+    table = quote_identifier(sheet)
+    conn.execute(f"DROP TABLE IF EXISTS {table}")
+    if not columns:
+        return columns
+
+    types = [_ARRAY_TYPES.get(pd.api.types.infer_dtype(array, skipna=True), "TEXT") for array in arrays]
+    definitions = ", ".join(f"{quote_identifier(column)} {column_type}".rstrip() for column, column_type in zip(columns, types))
+    conn.execute(f"CREATE TABLE {table} ({definitions})")
+
+    rows = zip(*map(_sql_values, arrays))
+    insert = f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})"
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        conn.executemany(insert, batch)
+    return columns
+
+
+def _sql_value(value):
+    """Converts a cell value sqlite3 can't store directly, dates are stored as text like pandas does"""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(" ")
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return int(value)
+    return str(value)
+
+
+def _add_types(seen, values):
+    """Adds the types of a sequence of values to the set seen, with "fraction" for floats that aren't whole and "time" for datetimes with a time"""
+    seen.update(map(type, values))
+    if float in seen and "fraction" not in seen:
+        if any(type(value) is float and not value.is_integer() for value in values):
+            seen.add("fraction")
+    if datetime.datetime in seen and "time" not in seen:
+        if any(type(value) is datetime.datetime and (value.hour or value.minute or value.second or value.microsecond) for value in values):
+            seen.add("time")
+    return seen
+
+
+def _column_type(seen):
+    """Picks a column type for the value types seen by _add_types, as compact as the values allow"""
+    types = seen - {type(None), "fraction", "time"}
+    if not types:
+        return ""
+    if types <= {int, bool} or types <= {int, bool, float} and "fraction" not in seen:
+        return "INTEGER"  # floats like 3.0 are stored as integers
+    if types <= {int, bool, float}:
+        return "REAL"
+    if types <= {datetime.datetime, datetime.date}:
+        return "TIMESTAMP" if "time" in seen else "DATE"  # dates without a time are stored as dates
+    return "TEXT"
+
+
+def _normalize_dates(values, date_columns):
+    """Drops the midnight time from the values of DATE columns, so they are stored like the dates pandas writes"""
+    for i in date_columns:
+        value = values[i]
+        if type(value) is str and len(value) == 19 and value.endswith(" 00:00:00"):
+            values[i] = value[:10]
+    return values
+
+
+def _retype_table(conn, table, columns, old_types, new_types):
+    """Copies a table into one with new column types, in the caller's transaction
+
+    Values are converted by the new columns' affinity, dates of former DATE columns get their
+    midnight time back. The table isn't renamed, renaming checks the views of the sheets.
+    """
+    conn.execute(f"CREATE TEMP TABLE _excel_sql_retype AS SELECT * FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    definitions = ", ".join(f"{quote_identifier(column)} {column_type}".rstrip() for column, column_type in zip(columns, new_types))
+    conn.execute(f"CREATE TABLE {table} ({definitions})")
+    values = []
+    for column, old_type, new_type in zip(map(quote_identifier, columns), old_types, new_types):
+        if old_type == "DATE" and new_type != "DATE":
+            column = f"CASE WHEN typeof({column}) = 'text' AND length({column}) = 10 THEN {column} || ' 00:00:00' ELSE {column} END"
+        values.append(column)
+    conn.execute(f"INSERT INTO {table} SELECT {', '.join(values)} FROM temp._excel_sql_retype")
+    conn.execute("DROP TABLE temp._excel_sql_retype")
+
+
+def stream_sheet(conn, input_file, sheet, batch_size=STREAM_BATCH_SIZE, cancelled=None):
+    """Streams the rows of a sheet into its table with executemany, memory use is bounded by the batch size"""
+    table = quote_identifier(sheet)
+    conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+    with _sheet_rows(input_file, sheet) as (columns, rows):
+        if columns is None:
+            return []
+
+        types = []  # declared column types
+        seen = []  # value types of every batch so far, per column
+        date_columns = []
+        batch = []
+
+        def flush():
+            if cancelled is not None and cancelled.is_set():
+                raise QueryCancelled()
+
+            # Values right of the header get "Unnamed: n" columns, like pandas does
+            for i in range(len(columns), max(len(row) for row in batch)):
+                columns.append(f"Unnamed: {i}")
+                if types:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {quote_identifier(columns[i])}")
+                    types.append("")
+
+            seen.extend(set() for _ in range(len(seen), len(columns)))
+            for column_seen, values in zip(seen, zip_longest(*batch)):
+                _add_types(column_seen, values)
+
+            # Columns are created with the types of the first batch, later values that don't fit them retype the table at the end
+            if not types:
+                types.extend(map(_column_type, seen))
+                definitions = ", ".join(f"{quote_identifier(column)} {column_type}".rstrip() for column, column_type in zip(columns, types))
+                conn.execute(f"CREATE TABLE {table} ({definitions})")
+                date_columns.extend(i for i, column_type in enumerate(types) if column_type == "DATE")
+
+            values = ([value if type(value) in _PLAIN_TYPES else _sql_value(value) for value in row]
+                      + [None] * (len(columns) - len(row)) for row in batch)
+            if date_columns:
+                values = map(_normalize_dates, values, repeat(date_columns))
+            conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})", values)
+            batch.clear()
+
+        for row in rows:
+            if len(row) > len(columns):
+                row = list(row)
+                while len(row) > len(columns) and row[-1] is None:
+                    row.pop()
+            if any(value is not None for value in row):  # pandas skips blank rows too
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    flush()
+
+        if batch:
+            flush()
+        if not types:  # header without any rows
+            conn.execute(f"CREATE TABLE {table} ({', '.join(map(quote_identifier, columns))})")
+        elif [_column_type(column_seen) for column_seen in seen] != types:
+            _retype_table(conn, table, columns, types, list(map(_column_type, seen)))
+        return columns
+
+
+def sheet_to_file(input_file, sheet, db_path, stream=True):
+    """Streams or bulk inserts a sheet into its own scratch database, used by the worker processes
+
+    A scratch database that wasn't finished is thrown away, so it needs no journal and no syncing.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        if stream:
+            columns = stream_sheet(conn, input_file, sheet)
+        else:
+            columns = bulk_store_sheet(conn, sheet, *parse_sheet(input_file, sheet))
+        conn.commit()
+        return columns
+    finally:
+        conn.close()
+
+
+def copy_sheet(conn, sheet, db_path):
+    """Copies a sheet's table from a scratch database into the workbook database"""
+    table = quote_identifier(sheet)
+    conn.execute("ATTACH DATABASE ? AS scratch", (db_path,))
+    try:
+        conn.execute("BEGIN")
+        conn.execute(f"DROP TABLE IF EXISTS main.{table}")
+        row = conn.execute("SELECT sql FROM scratch.sqlite_master WHERE type = 'table' AND name = ?", (sheet,)).fetchone()
+        if row:
+            conn.execute(row[0])
+            conn.execute(f"INSERT INTO main.{table} SELECT * FROM scratch.{table}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("DETACH DATABASE scratch")
+
+
+def _ingest_task(args):
+    """Worker process entry point, ingests a sheet into a scratch database or parses it with pandas"""
+    input_file, sheet, scratch_path, stream = args
+    if scratch_path:
+        return sheet, sheet_to_file(input_file, sheet, scratch_path, stream)
+    return sheet, parse_sheet(input_file, sheet)
+
+
+def read_only_connection(db_path, attached=None, **options):
+    """Opens a read-only connection to a workbook database with the attached ones, {alias: db_path}, attached read-only too"""
+    conn = sqlite3.connect(f"file:{pathname2url(db_path)}?mode=ro", uri=True, **options)
+    conn.execute("PRAGMA mmap_size = 268435456")
+    for alias, attached_path in (attached or {}).items():
+        conn.execute(f"ATTACH DATABASE ? AS {quote_identifier(alias)}", (f"file:{pathname2url(attached_path)}?mode=ro",))
+    return conn
+
+
+def split_script(sql):
+    """Splits a script into [(name, statement)], a "-- name: Totals" comment in front of a statement names it
+
+    Statements without a name are called Query1, Query2, ... by their position.
+    """
+    statements = []
+    buffer = ""
+    parts = sql.split(";")
+    for i, part in enumerate(parts):
+        buffer += part if i == len(parts) - 1 else part + ";"
+        # A ; inside a string or a comment doesn't end the statement
+        if i < len(parts) - 1 and not sqlite3.complete_statement(buffer):
+            continue
+        if normalize_sql(buffer):
+            name = _STATEMENT_NAME.search(buffer)
+            statements.append((name.group(1) if name else f"Query{len(statements) + 1}", buffer.strip()))
+        buffer = ""
+    return statements
+
+
+class ResultPager:
+    """Pages through a query result on its own read-only connection, reading rows only once they are asked for
+
+    Rows are read forward from one cursor, so paging down is cheap. Pages that fell out of the page
+    cache, or that come after a jump or after release(), are read with a new cursor at an OFFSET.
+    """
+
+    def __init__(self, db_path, sql, attached=None):
+        self.sql = normalize_sql(sql)  # without comments, a trailing -- comment would swallow the subquery's ")"
+        self.conn = read_only_connection(db_path, attached, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.pages = OrderedDict()
+        self.cursor = None
+        self.position = 0  # rows read from the cursor
+        self.row_count = None  # known once the last row was read
+        self._open(0)
+        self.columns = [description[0] for description in self.cursor.description or []]
+        if not self.columns:
+            self.close()
+            raise ValueError("The query doesn't return any rows to preview.")
+
+
+    def _open(self, offset):
+        """Starts a new cursor at a row offset"""
+        if self.cursor is not None:
+            self.cursor.close()
+        sql = f"SELECT * FROM ({self.sql}) LIMIT -1 OFFSET {int(offset)}" if offset else self.sql
+        self.cursor = self.conn.execute(sql)
+        self.position = offset
+
+
+    def _page(self, number):
+        """Returns the rows of a page, reading them if they aren't cached"""
+        if number in self.pages:
+            self.pages.move_to_end(number)
+            return self.pages[number]
+        start = number * PAGE_SIZE
+        if self.row_count is not None and start >= self.row_count:
+            return []
+
+        # Read on from the running cursor if the page is close ahead, caching the pages in between
+        if self.cursor is None or not self.position <= start <= self.position + PAGE_SIZE * PAGE_CACHE_SIZE:
+            self._open(start)
+        while True:
+            rows = self.cursor.fetchmany(PAGE_SIZE)
+            page = self.position // PAGE_SIZE
+            self.position += len(rows)
+            if len(rows) < PAGE_SIZE:
+                # Done, closing the cursor releases its read lock on the database
+                self.row_count = self.position
+                self.cursor.close()
+                self.cursor = None
+            self.pages[page] = rows
+            if len(self.pages) > PAGE_CACHE_SIZE:
+                self.pages.popitem(last=False)
+            if page >= number or self.cursor is None:
+                return rows if page == number else []
+
+
+    def rows(self, offset, count):
+        """Returns up to count rows starting at offset"""
+        with self.lock:
+            if self.conn is None:
+                raise ValueError("The preview was closed because the data changed, preview the query again.")
+            rows = []
+            for number in range(offset // PAGE_SIZE, (offset + count - 1) // PAGE_SIZE + 1):
+                page = self._page(number)
+                rows.extend(page)
+                if len(page) < PAGE_SIZE:
+                    break
+            first = offset - offset // PAGE_SIZE * PAGE_SIZE
+            return rows[first:first + count]
+
+
+    def known_rows(self):
+        """Returns (rows seen so far, whether that is all of them)"""
+        if self.row_count is not None:
+            return self.row_count, True
+        return max(self.position, max(self.pages, default=-1) * PAGE_SIZE + PAGE_SIZE), False
+
+
+    def release(self):
+        """Closes the running cursor, so a write to the database doesn't have to wait for it"""
+        with self.lock:
+            if self.cursor is not None:
+                self.cursor.close()
+                self.cursor = None
+
+
+    def close(self):
+        """Closes the connection, the pager can't be used afterwards"""
+        # A read jumping to a far offset holds the lock until it is done, interrupting it lets go right away
+        conn = self.conn
+        if conn is not None:
+            try:
+                conn.interrupt()
+            except sqlite3.ProgrammingError:
+                pass  # closed meanwhile
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+                self.cursor = None
+
+
+class Workbook:
+    """A loaded input file and the long-lived SQLite connection to its data"""
+
+    def __init__(self, path, cache, workers=DEFAULT_WORKERS, ingest="stream"):
+        self.path = os.path.abspath(path)
+        self.cache = cache
+        self.workers = workers
+        self.ingest = ingest
+        self.db_path = None
+        self.conn = None
+        self.fingerprint = None
+        self.sheets = {}
+        self.sheet_fingerprints = {}
+        self.pending = set()
+        self.lock = threading.RLock()
+        self.cancelled = threading.Event()
+        self.pagers = weakref.WeakSet()
+        self.attached = {}  # alias: Workbook whose database is attached to conn under that schema name
+
+
+    def load(self, rebuild=False, on_sheet_names=None, on_sheet=None, on_stage=None):
+        """Opens the cached database for the file, reading the headers first if it isn't cached
+
+        on_stage is called with the name of each step as it starts, for timing them.
+        """
+        on_stage = on_stage or (lambda stage: None)
+        with self.lock:
+            self.close()
+            if rebuild:
+                self.cache.invalidate(self.path)
+
+            # Reuse the parsed sheets if this exact file was loaded before
+            on_stage("fingerprint")
+            db_path, fingerprint = self.cache.lookup(self.path)
+            on_stage("headers")
+            if db_path is None:
+                tmp_path = self.cache.build_path(fingerprint)
+                create_cache_db(self.path, tmp_path, on_sheet_names, on_sheet)
+                db_path = self.cache.store(fingerprint, tmp_path)
+                self.sheets = read_sheets(db_path)
+            else:
+                self.sheets = read_sheets(db_path)
+                if on_sheet_names:
+                    on_sheet_names(list(self.sheets))
+                for sheet in self.sheets if on_sheet else []:
+                    on_sheet(sheet)
+
+            self.db_path = db_path
+            self.fingerprint = fingerprint
+            on_stage("sheet fingerprints")
+            self.sheet_fingerprints = sheet_fingerprints(self.path) or {}
+
+            self._connect()
+            self.pending = {row[0] for row in self.conn.execute(f"SELECT name FROM {SHEETS_TABLE} WHERE ingested = 0")}
+            # Databases cached before the views were added get them now
+            create_sheet_views(self.conn, list(self.sheets))
+            self.conn.commit()
+        return self.sheets
+
+
+    def _connect(self):
+        """Opens the connection to the database and attaches the attached workbooks to it"""
+        # Shared between the load and query threads, access is serialised by self.lock
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.cache.hold(self.fingerprint)
+        self.conn.execute("PRAGMA mmap_size = 268435456")
+        for alias in self.attached:
+            self._attach(alias)
+
+
+    def _attach(self, alias):
+        """Runs ATTACH for an attached workbook's database"""
+        self.conn.execute(f"ATTACH DATABASE ? AS {quote_identifier(alias)}", (self.attached[alias].db_path,))
+
+
+    def attach(self, alias, workbook):
+        """Makes a loaded workbook's sheets available as alias.Sheet, its sheets are still parsed and cached on their own
+
+        A workbook can be attached to itself, so its sheets can be named the same way as the others'.
+        """
+        with self.lock:
+            self.attached[alias] = workbook
+            self._attach(alias)
+
+
+    def detach(self, alias):
+        """Removes an attached workbook, returns it"""
+        with self.lock:
+            self._release_pagers(close=True)
+            self.conn.execute(f"DETACH DATABASE {quote_identifier(alias)}")
+            return self.attached.pop(alias)
+
+
+    def _refresh_attached(self):
+        """Reloads the attached workbooks whose files changed, detaching them meanwhile as their databases may move"""
+        for alias, workbook in self.attached.items():
+            if workbook is not self and workbook.is_stale():
+                self._release_pagers(close=True)
+                self.conn.execute(f"DETACH DATABASE {quote_identifier(alias)}")
+                try:
+                    workbook.refresh()
+                finally:
+                    self._attach(alias)
+
+
+    def is_stale(self):
+        """Checks whether the file on disk changed since it was loaded"""
+        if self.fingerprint is None:
+            return True
+        try:
+            current = file_fingerprint(self.path, with_hash=False)
+        except OSError:
+            return False  # file is gone, keep working with what was loaded
+        return (current["size"], current["mtime"]) != (self.fingerprint["size"], self.fingerprint["mtime"])
+
+
+    def refresh(self, on_sheet_names=None, on_sheet=None, on_stage=None):
+        """Reloads the file if it changed on disk, returns the sheets that were reloaded or None if it didn't change
+
+        Only sheets that changed are read again, the others keep their rows and indexes.
+        """
+        with self.lock:
+            self._refresh_attached()
+            if not self.is_stale():
+                return None
+            try:
+                changed = self._reload_changed(on_stage or (lambda stage: None))
+            except Exception:
+                if self.cancelled.is_set():
+                    raise QueryCancelled() from None
+                raise
+            if changed is None:
+                self.load(on_sheet_names=on_sheet_names, on_sheet=on_sheet, on_stage=on_stage)
+                return set(self.sheets)
+
+            if on_sheet_names:
+                on_sheet_names(list(self.sheets))
+            for sheet in self.sheets if on_sheet else []:
+                on_sheet(sheet)
+            return changed
+
+
+    def _reload_changed(self, on_stage):
+        """Updates the cache database in place for a new version of the file, returns the changed sheets
+
+        Returns None if the file has to be loaded from scratch instead.
+        """
+        on_stage("fingerprint")
+        changed = changed_sheets(self.conn, self.path)
+        if changed is None:
+            return None
+        db_path, fingerprint = self.cache.lookup(self.path)
+        if db_path is not None:
+            return None  # this version was loaded before, opening its database is quicker
+
+        on_stage("headers")
+        ingested = dict(self.conn.execute(f"SELECT name, ingested FROM {SHEETS_TABLE}").fetchall())
+        self.indexes()  # makes sure the index table exists
+        self.close()
+        self.db_path = self.cache.rekey(self.fingerprint, fingerprint)
+        self.fingerprint = fingerprint
+        self._connect()
+
+        sheet_names, headers = read_headers(self.path)
+        self.conn.execute("BEGIN")
+        try:
+            for sheet in set(ingested) - set(sheet_names):
+                self.conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(sheet)}")
+                self.conn.execute(f"DELETE FROM {INDEXES_TABLE} WHERE sheet = ?", (sheet,))
+                if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = ?", (sql_name(sheet),)).fetchone():
+                    self.conn.execute(f"DROP VIEW {quote_identifier(sql_name(sheet))}")
+            self.conn.execute(f"DELETE FROM {SHEETS_TABLE}")
+            for position, (sheet, columns) in enumerate(headers):
+                if sheet in changed or sheet not in ingested:
+                    # Back to a placeholder, the sheet's indexes are restored when it's parsed again
+                    self.conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(sheet)}")
+                    if columns:
+                        self.conn.execute(f"CREATE TABLE {quote_identifier(sheet)} ({', '.join(map(quote_identifier, columns))})")
+                    self.conn.execute(f"INSERT INTO {SHEETS_TABLE} VALUES (?, ?, 0)", (position, sheet))
+                else:
+                    self.conn.execute(f"INSERT INTO {SHEETS_TABLE} VALUES (?, ?, ?)", (position, sheet, ingested[sheet]))
+            create_sheet_views(self.conn, sheet_names)
+            store_parts(self.conn, self.path)
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+        self.sheets = read_sheets(self.db_path)
+        self.sheet_fingerprints = sheet_fingerprints(self.path) or {}
+        self.pending = {row[0] for row in self.conn.execute(f"SELECT name FROM {SHEETS_TABLE} WHERE ingested = 0")}
+
+        # Sheets that were parsed before are parsed again right away, the rest stays lazy
+        on_stage("parse")
+        self._ensure_sheets({sheet for sheet in changed if ingested.get(sheet)})
+        self.cache.update_size(self.fingerprint)
+        return changed & set(self.sheets)
+
+
+    def referenced_sheets(self, sql):
+        """Returns the sheets of this workbook a query reads"""
+        return self._referenced_tables(sql).get(self, set())
+
+
+    def _referenced_tables(self, sql):
+        """Returns {workbook: sheets} a query reads, found from the tables its compiled program opens
+
+        Covers this workbook and the attached ones.
+        """
+        with self.lock:
+            try:
+                program = self.conn.execute(f"EXPLAIN {sql}").fetchall()
+            except sqlite3.OperationalError as e:
+                if "no such column" not in str(e):
+                    raise
+                # Probably a column the header-only placeholders don't know about yet, like "Unnamed: 5",
+                # the pending sheets the query names are parsed to find out
+                names = sql_names(sql)
+                return {workbook: {sheet for sheet in workbook.pending if sheet.lower() in names or sql_name(sheet).lower() in names}
+                        for workbook in {self, *self.attached.values()}}
+
+            # OpenRead's p2 is the root page of the table or index being read, p3 the database
+            root_pages = {(row[4], row[3]) for row in program if row[1] in ("OpenRead", "ReopenIdx")}
+            tables = {}
+            for database, name, _ in self.conn.execute("PRAGMA database_list").fetchall():
+                workbook = self if name == "main" else self.attached.get(name)
+                if workbook is None:
+                    continue
+                rows = self.conn.execute(f"SELECT rootpage, tbl_name FROM {quote_identifier(name)}.sqlite_master WHERE rootpage > 0").fetchall()
+                tables.setdefault(workbook, set()).update(table for rootpage, table in rows
+                                                          if (database, rootpage) in root_pages and table in workbook.sheets)
+        return tables
+
+
+    def _ensure_referenced(self, sql, on_sheet=None):
+        """Parses the sheets a query reads that haven't been yet, in this workbook and the attached ones"""
+        for workbook, sheets in self._referenced_tables(sql).items():
+            if workbook is self:
+                self._ensure_sheets(sheets, on_sheet)
+            elif sheets:
+                workbook.ensure_sheets(sheets, on_sheet)
+
+
+    def result_key(self, sql, output_file):
+        """Returns the result cache key of a query on the current data, None if its result can't be cached"""
+        if is_volatile(sql):
+            return None
+        with self.lock:
+            # Sheets without a fingerprint of their own (.xls and .csv files) use the whole file's
+            fingerprints = {}
+            for workbook, sheets in self._referenced_tables(sql).items():
+                prefix = "" if workbook is self else f"{workbook.path}|"
+                fingerprints.update((prefix + sheet, workbook.sheet_fingerprints.get(sheet) or workbook.fingerprint["hash"])
+                                    for sheet in sheets)
+        return ResultCache.key(sql, fingerprints, os.path.splitext(output_file)[1].lower(), self.ingest)
+
+
+    def ensure_sheets(self, sheets, on_sheet=None):
+        """Parses the given sheets into the database if they haven't been yet, in parallel if there are several"""
+        with self.lock:
+            try:
+                self._ensure_sheets(sheets, on_sheet)
+            except Exception:
+                # Interrupted statements raise OperationalError
+                if self.cancelled.is_set():
+                    raise QueryCancelled() from None
+                raise
+
+
+    def _ensure_sheets(self, sheets, on_sheet=None):
+        """Parses the pending sheets among sheets, stops with QueryCancelled when cancelled"""
+        todo = [sheet for sheet in self.sheets if sheet in sheets and sheet in self.pending]
+        stream = self.ingest == "stream" and is_streamable(self.path)
+        to_sql = self.ingest == "pandas"  # other sheets parsed with pandas are bulk inserted
+        if todo:
+            self._release_pagers()
+
+        if len(todo) > 1 and self.workers > 1:
+            # Workers write into scratch databases, SQLite only allows one writer per file
+            scratch = {sheet: None if to_sql else f"{self.db_path}.{i}.part" for i, sheet in enumerate(todo)}
+            try:
+                # Leaving the with block terminates the workers, also when cancelled
+                with multiprocessing.Pool(min(self.workers, len(todo))) as pool:
+                    results = pool.imap_unordered(_ingest_task, [(self.path, sheet, scratch[sheet], stream) for sheet in todo])
+
+                    # Ingest each sheet as soon as its worker is done
+                    for done in range(1, len(todo) + 1):
+                        sheet, result = self._next_result(results)
+                        if scratch[sheet]:
+                            copy_sheet(self.conn, sheet, scratch[sheet])
+                            columns = result
+                        else:
+                            columns = store_sheet(self.conn, sheet, *result)
+                        self._mark_ingested(sheet, columns)
+                        if on_sheet:
+                            on_sheet(sheet, done, len(todo))
+            finally:
+                for path in scratch.values():
+                    if path and os.path.exists(path):
+                        os.remove(path)
+        else:
+            for done, sheet in enumerate(todo, 1):
+                self._check_cancelled()
+                # One transaction per sheet, a cancelled sheet keeps its placeholder table
+                self.conn.execute("BEGIN")
+                try:
+                    if stream:
+                        columns = stream_sheet(self.conn, self.path, sheet, cancelled=self.cancelled)
+                    elif to_sql:
+                        columns = store_sheet(self.conn, sheet, *parse_sheet(self.path, sheet))
+                    else:
+                        columns = bulk_store_sheet(self.conn, sheet, *parse_sheet(self.path, sheet))
+                    self._mark_ingested(sheet, columns)
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+                if on_sheet:
+                    on_sheet(sheet, done, len(todo))
+
+        if todo:
+            self.cache.update_size(self.fingerprint)
+
+
+    def _next_result(self, results):
+        """Waits for the next finished worker while watching for cancellation"""
+        while True:
+            self._check_cancelled()
+            try:
+                return results.next(timeout=0.2)
+            except multiprocessing.TimeoutError:
+                continue
+
+
+    def _check_cancelled(self):
+        """Raises QueryCancelled if cancel() was called"""
+        if self.cancelled.is_set():
+            raise QueryCancelled()
+
+
+    def cancel(self):
+        """Stops the running query, sheet parsing or output writing as soon as possible"""
+        self.cancelled.set()
+        for workbook in self.attached.values():
+            if workbook is not self:
+                workbook.cancel()
+        conn = self.conn
+        if conn is not None:
+            conn.interrupt()
+
+
+    def reset_cancel(self):
+        """Clears an earlier cancel(), called when a run starts so that a cancel pressed before it reaches the engine isn't lost"""
+        self.cancelled.clear()
+        for workbook in self.attached.values():
+            if workbook is not self:
+                workbook.reset_cancel()
+
+
+    def _mark_ingested(self, sheet, columns):
+        """Records that a sheet's rows are in the database and restores its indexes"""
+        self.conn.execute(f"UPDATE {SHEETS_TABLE} SET ingested = 1 WHERE name = ?", (sheet,))
+        for name, table, index_columns in self.indexes(sheet):
+            if all(column in columns for column in index_columns):
+                self._create_index(name, table, index_columns)
+        self.conn.commit()
+        self.sheets[sheet] = columns
+        self.pending.discard(sheet)
+
+
+    def indexes(self, sheet=None):
+        """Returns [(name, sheet, columns)] of the indexes created on the loaded sheets"""
+        with self.lock:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {INDEXES_TABLE} (name TEXT PRIMARY KEY, sheet TEXT, columns TEXT)")
+            rows = self.conn.execute(f"SELECT name, sheet, columns FROM {INDEXES_TABLE} WHERE ? IS NULL OR sheet = ? ORDER BY sheet, name",
+                                     (sheet, sheet)).fetchall()
+        return [(name, table, columns.split("\n")) for name, table, columns in rows]
+
+
+    def create_index(self, sheet, columns):
+        """Creates an index on a sheet, kept in the cache database with the sheet, returns its name"""
+        # The hash tells apart names with underscores, sheet "a_b" on (c) and sheet "a" on (b, c)
+        digest = hashlib.sha1(json.dumps([sheet, list(columns)]).encode()).hexdigest()[:8]
+        name = f"idx_{sheet}_{'_'.join(columns)}_{digest}"
+        with self.lock:
+            self.ensure_sheets({sheet})  # indexing the placeholder would be lost once the sheet is parsed
+            self._release_pagers()
+            self.indexes()
+            try:
+                self.conn.execute(f"INSERT OR REPLACE INTO {INDEXES_TABLE} VALUES (?, ?, ?)", (name, sheet, "\n".join(columns)))
+                self._create_index(name, sheet, columns)
+            except Exception:
+                self.conn.rollback()
+                if self.cancelled.is_set():
+                    raise QueryCancelled() from None
+                raise
+            self.conn.commit()
+            self.cache.update_size(self.fingerprint)
+        return name
+
+
+    def _create_index(self, name, sheet, columns):
+        """Runs CREATE INDEX for an index of a sheet"""
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {quote_identifier(name)} ON {quote_identifier(sheet)} "
+                          f"({', '.join(map(quote_identifier, columns))})")
+
+
+    def drop_index(self, name):
+        """Drops an index created with create_index"""
+        with self.lock:
+            self._release_pagers()
+            self.conn.execute(f"DROP INDEX IF EXISTS {quote_identifier(name)}")
+            self.conn.execute(f"DELETE FROM {INDEXES_TABLE} WHERE name = ?", (name,))
+            self.conn.commit()
+
+
+    def pager(self, sql):
+        """Parses the sheets a query reads and returns a ResultPager over its result"""
+        with self.lock:
+            self._ensure_referenced(sql)
+            pager = ResultPager(self.db_path, sql, {alias: workbook.db_path for alias, workbook in self.attached.items()})
+            # Any of the databases being written to has to release the pager first
+            for workbook in {self, *self.attached.values()}:
+                workbook.pagers.add(pager)
+        return pager
+
+
+    def _release_pagers(self, close=False):
+        """Lets the open pagers go of the database before it is written to, or closes them if it is replaced"""
+        for pager in list(self.pagers):
+            if close:
+                pager.close()
+            else:
+                pager.release()
+
+
+    def run(self, sql, write, on_sheet=None, on_stage=None, on_progress=None):
+        """Runs a query and passes its cursor to write, returns what write returns
+
+        on_stage is called with "parse" before the sheets the query reads are parsed and with
+        "query" before the query starts, on_progress every PROGRESS_INTERVAL SQLite VM steps.
+        """
+        on_stage = on_stage or (lambda stage: None)
+
+        def progress():
+            if on_progress:
+                on_progress()
+            return int(self.cancelled.is_set())
+
+        with self.lock:
+            # Lets cancel() stop long statements, on top of interrupt() for the one that is running
+            self.conn.set_progress_handler(progress, PROGRESS_INTERVAL)
+            try:
+                on_stage("parse")
+                self._ensure_referenced(sql, on_sheet)
+
+                # The cache must not be altered by the query itself
+                on_stage("query")
+                self.conn.execute("PRAGMA query_only = ON")
+                cursor = self.conn.cursor()
+                try:
+                    return write(cursor.execute(sql))
+                finally:
+                    cursor.close()
+            except Exception:
+                if self.cancelled.is_set():
+                    raise QueryCancelled() from None
+                raise
+            finally:
+                self.conn.set_progress_handler(None, 0)
+                self.conn.execute("PRAGMA query_only = OFF")
+
+
+    def run_script(self, statements, write, workers=DEFAULT_WORKERS, on_sheet=None, on_stage=None, on_query=None):
+        """Runs several queries at once, each on its own read-only connection, returns the rows of each
+
+        statements are [(name, sql)], write(position, name, cursor) is called from the worker threads
+        and returns the number of rows. on_query(position, status, detail) reports each query as
+        "running", "done" with its rows or "error" with the message. The first failing query stops
+        the others.
+        """
+        on_stage = on_stage or (lambda stage: None)
+        on_query = on_query or (lambda position, status, detail: None)
+
+        with self.lock:
+            try:
+                on_stage("parse")
+                for _, sql in statements:
+                    self._ensure_referenced(sql, on_sheet)
+            except Exception:
+                if self.cancelled.is_set():
+                    raise QueryCancelled() from None
+                raise
+
+            on_stage("query")
+            self._release_pagers()
+            attached = {alias: workbook.db_path for alias, workbook in self.attached.items()}
+
+            errors = []  # (name, error) of the failed queries, in the order they failed
+
+            def run_one(position):
+                name, sql = statements[position]
+                self._check_cancelled()
+                conn = read_only_connection(self.db_path, attached)
+                conn.set_progress_handler(lambda: int(self.cancelled.is_set()), PROGRESS_INTERVAL)
+                on_query(position, "running", None)
+                try:
+                    rows = write(position, name, conn.execute(sql))
+                except Exception as e:
+                    if self.cancelled.is_set():
+                        raise QueryCancelled() from None
+                    on_query(position, "error", str(e))
+                    errors.append((name, e))
+                    raise
+                finally:
+                    conn.close()
+                on_query(position, "done", rows)
+                return rows
+
+            # SQLite lets go of the GIL while it runs a statement, so the queries run side by side in threads
+            with ThreadPoolExecutor(max(1, min(workers, len(statements)))) as pool:
+                futures = [pool.submit(run_one, position) for position in range(len(statements))]
+                wait(futures, return_when=FIRST_EXCEPTION)
+                if any(future.done() and future.exception() is not None for future in futures):
+                    self.cancelled.set()  # stops the queries still running
+                    wait(futures)
+                    if errors:
+                        name, error = errors[0]
+                        raise ScriptError(f"{name}: {error}") from error
+                    raise QueryCancelled()
+                return [future.result() for future in futures]
+
+
+    def close(self):
+        """Closes the connection to the loaded data"""
+        with self.lock:
+            self._release_pagers(close=True)
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+                self.cache.release(self.fingerprint)
@@ -1,15 +1,20 @@
 #! /usr/bin/env python3
 #  -*- coding: utf-8 -*-
+import multiprocessing
+import queue
 import subprocess
+import sys
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
+from tkinter import filedialog, messagebox, simpledialog, ttk
 import os.path
 import threading
 import time
-import pandas as pd
-import openpyxl
-import sqlite3
-from openpyxl.worksheet.table import Table, TableStyleInfo
+from cache import ResultCache, WorkbookCache
+from engine import DEFAULT_WORKERS, INGEST_MODES, QueryCancelled, Workbook, schema_alias, split_script
+from advisor import advise
+from profiler import explain, profile
+from writers import result_names, script_writer, write_result
+from telemetry import Telemetry, TimedCursor, default_log_path, format_stages, peak_rss_bytes, rss_bytes
 
 _location = os.path.dirname(__file__)
 
@@ -35,6 +40,32 @@ DARK_MODE = {
     "bg_active": "#666"
 }
 
+# Rows the result preview shows at once
+PREVIEW_ROWS = 25
+
+# Milliseconds between checks of the input file while watching it for changes
+WATCH_INTERVAL = 2000
+
+# Milliseconds between updates of the memory shown in the window
+MEMORY_INTERVAL = 1000
+
+# Milliseconds between runs of the queued UI updates, and the most updates run at once
+UI_DRAIN_INTERVAL = 50
+UI_BATCH_SIZE = 500
+
+INPUT_FILETYPES = [
+    ("Excel and CSV Files", "*.xlsx;*.xlsm;*.xls;*.csv"),
+    ("Excel Files", "*.xlsx;*.xlsm;*.xls"),
+    ("CSV Files", "*.csv"),
+]
+
+OUTPUT_FILETYPES = [
+    ("Excel Files", "*.xlsx"),
+    ("CSV Files", "*.csv"),
+    ("Parquet Files", "*.parquet"),
+    ("SQLite Databases", "*.sqlite;*.db"),
+]
+
 class MainWindow:
     def __init__(self, top=None):
         """Configures and populates the toplevel window"""
@@ -52,7 +83,7 @@ class MainWindow:
         self.top = top
         self.input_file = None
         self.output_file = None
-        self.query_start_time = 0
+        self.telemetry = None
         self.timer_running = False
         self.elapsed = 0
         self.done_loading = False
@@ -60,7 +91,31 @@ class MainWindow:
         self.query_running = False
         self.char_list = [' ', '\n', ',', '.', '[', ']', '(', ')', '\'']
         self.current_theme = LIGHT_MODE
-        self.skip_load_dialog = False
+        self.cache = WorkbookCache()
+        self.result_cache = ResultCache()
+        self.use_result_cache = tk.BooleanVar(value=True)
+        self.result_status = ""
+        self.workbook = None
+        self.sheet_columns = {}
+        self.workspace_columns = {}  # alias.Sheet: columns of the other files in the workspace
+        self.workers = DEFAULT_WORKERS
+        self.ingest_mode = tk.StringVar(value=INGEST_MODES[0])
+        self.auto_indexes = tk.BooleanVar(value=False)
+        self.advisor_window = None
+        self.profiler_window = None
+        self.profiling = False
+        self.preview_window = None
+        self.preview_pager = None
+        self.preview_offset = 0
+        self.preview_loading = False
+        self.preview_generation = 0  # tells the reads of an earlier preview apart
+        self.log_runs = tk.BooleanVar(value=False)
+        self.watch_file = tk.BooleanVar(value=False)
+        self.watched_stat = None
+        self.reloading = False
+        self.script_window = None
+        self.ui_events = queue.Queue()  # (key, function, args, kwargs) queued from any thread, run by _drain_ui_events
+        self.memory_checked = 0
 
         ## GUI definition
 
@@ -68,7 +123,25 @@ class MainWindow:
         self.menu_bar = tk.Menu(self.top)
         self.settings_menu = tk.Menu(self.menu_bar, tearoff=0)
         self.settings_menu.add_command(label="Toggle Dark/Light Mode", command=self.toggle_theme)
+        self.settings_menu.add_command(label="Rebuild Cache", command=self.rebuild_cache)
+        self.settings_menu.add_command(label="Parse All Sheets", command=self.parse_all_sheets)
+        self.settings_menu.add_command(label="Parser Workers...", command=self.set_workers)
+        self.ingest_menu = tk.Menu(self.settings_menu, tearoff=0)
+        for mode in INGEST_MODES:
+            self.ingest_menu.add_radiobutton(label=mode.capitalize(), value=mode, variable=self.ingest_mode, command=self.set_ingest_mode)
+        self.settings_menu.add_cascade(label="Ingest Mode", menu=self.ingest_menu)
+        self.settings_menu.add_checkbutton(label="Create Suggested Indexes Automatically", variable=self.auto_indexes)
+        self.settings_menu.add_checkbutton(label="Reuse Cached Results", variable=self.use_result_cache)
+        self.settings_menu.add_checkbutton(label="Log Run Statistics", variable=self.log_runs)
+        self.settings_menu.add_checkbutton(label="Watch File for Changes", variable=self.watch_file, command=self.toggle_watch)
         self.menu_bar.add_cascade(label="Settings", menu=self.settings_menu)
+        self.workspace_menu = tk.Menu(self.menu_bar, tearoff=0)
+        self.workspace_menu.add_command(label="Add File...", command=self.add_workspace_file)
+        self.workspace_menu.add_command(label="Remove File...", command=self.remove_workspace_file)
+        self.menu_bar.add_cascade(label="Workspace", menu=self.workspace_menu)
+        self.queries_menu = tk.Menu(self.menu_bar, tearoff=0)
+        self.queries_menu.add_command(label="Run Saved Queries...", command=self.run_query_files)
+        self.menu_bar.add_cascade(label="Queries", menu=self.queries_menu)
         self.top.configure(menu=self.menu_bar)
 
         # Input File Selection
@@ -164,28 +237,51 @@ class MainWindow:
         self.cancel_button = tk.Button(self.sql_execute_frame, text="Cancel Query", command=self.cancel_query)
         self.cancel_button.pack(side="left", pady=2, padx=5)
 
+        self.profile_button = tk.Button(self.sql_execute_frame, text="Explain / Profile", command=self.show_profiler)
+        self.profile_button.pack(side="left", pady=2, padx=5)
+
+        self.preview_button = tk.Button(self.sql_execute_frame, text="Preview", command=self.preview_query)
+        self.preview_button.pack(side="left", pady=2, padx=5)
+
+        self.index_button = tk.Button(self.sql_execute_frame, text="Indexes", command=self.show_index_advisor)
+        self.index_button.pack(side="left", pady=2, padx=5)
+
         self.execution_time_label = tk.Label(self.sql_execute_frame, text="Time: 0s")
         self.execution_time_label.pack(side="right", pady=2, padx=5)
 
+        self.memory_label = tk.Label(self.sql_execute_frame, text="")
+        self.memory_label.pack(side="right", pady=2, padx=5)
+
+        # Time, rows/s and peak memory of each stage of the last load or query
+        self.stats_label = tk.Label(self.top, text="", anchor="w", justify="left", wraplength=560)
+        self.stats_label.pack(fill="x", padx=15, pady=(0, 5))
+
         # Apply initial theme
         self.apply_theme(self.top, self.current_theme)
 
+        self._drain_ui_events()
+
 
     def apply_theme(self, widget, theme):
         """Applies selected Theme"""
         try:
-            if not isinstance(widget, ttk.Scrollbar):
+            if not isinstance(widget, (ttk.Scrollbar, ttk.Treeview)):
                 widget.configure(bg=theme["bg"])
-            if not isinstance(widget, (tk.Frame, tk.Tk, ttk.Scrollbar)):
+            if not isinstance(widget, (tk.Frame, tk.Tk, tk.Toplevel, ttk.Scrollbar, ttk.Treeview)):
                 widget.configure(fg=theme["fg"])
             if isinstance(widget, (tk.Text, tk.Entry)): # set cursor color for text fields
                 widget.configure(insertbackground=theme["fg"])
             if isinstance(widget, ttk.Scrollbar):
                 style = ttk.Style()
                 style.theme_use("alt")
-                style.configure("Vertical.TScrollbar", troughcolor=theme["throughcolor"], background=theme["background"], arrowcolor=theme["arrowcolor"], bordercolor=theme["bordercolor"])
-                style.map("Vertical.TScrollbar", background=[("disabled", theme["bg_disabled"]), ("active", theme["bg_active"]), ("!disabled", theme["background"])])
-                widget.configure(style="Vertical.TScrollbar")
+                name = f"{str(widget.cget('orient')).capitalize()}.TScrollbar"
+                style.configure(name, troughcolor=theme["throughcolor"], background=theme["background"], arrowcolor=theme["arrowcolor"], bordercolor=theme["bordercolor"])
+                style.map(name, background=[("disabled", theme["bg_disabled"]), ("active", theme["bg_active"]), ("!disabled", theme["background"])])
+                widget.configure(style=name)
+            if isinstance(widget, ttk.Treeview):
+                style = ttk.Style()
+                style.configure("Treeview", background=theme["bg"], foreground=theme["fg"], fieldbackground=theme["bg"])
+                style.configure("Treeview.Heading", background=theme["background"], foreground=theme["fg"])
         except Exception as e:
             print(f"Couldn't set theme for {widget}, {e}")
 
@@ -205,61 +301,273 @@ class MainWindow:
 
     def load_file(self, event=None):
         """Start file loading in a separate thread to prevent UI freeze"""
+        # The file dialog stays on the Tk thread, pressing enter loads the typed path
         if event:
-            self.skip_load_dialog = True
-        threading.Thread(target=self._load_file_thread, daemon=True).start()
+            file = self.input_entry.get()
+        else:
+            file = filedialog.askopenfilename(title="Select Input Excel File", filetypes=INPUT_FILETYPES)
+        if file:
+            threading.Thread(target=self._load_file_thread, args=(file, self.ingest_mode.get(), self._log_file()), daemon=True).start()
 
 
-    def _load_file_thread(self):
-        """Loads the file in a separate thread to avoid freezing the UI"""
-        if not self.skip_load_dialog:
-            file = filedialog.askopenfilename(title="Select Input Excel File", filetypes=[("Excel Files", "*.xlsx;*.xls")])
-        else:
-            file = self.input_entry.get()
+    def rebuild_cache(self):
+        """Drops the cached copy of the input file and loads it again"""
+        if not self.input_file:
+            messagebox.showinfo("No File", "Please load a file first.")
+            return
+        threading.Thread(target=self._load_file_thread, args=(self.input_entry.get(), self.ingest_mode.get(), self._log_file(), True),
+                         daemon=True).start()
 
+
+    def _load_file_thread(self, file, ingest, log_file, rebuild=False):
+        """Loads the file in a separate thread to avoid freezing the UI, the settings are read on the Tk thread"""
         self.done_loading = False
-        self.skip_load_dialog = False
 
         if file:
             # Show "Loading sheets..." before starting the process
-            self.top.after(0, lambda: self.sheet_listbox.delete(0, tk.END))
-            self.top.after(0, lambda: self.sheet_listbox.insert(tk.END, "Loading sheets..."))
+            self.post(self._set_sheet_list, ["Loading sheets..."])
 
             self.input_file = file
-            self.top.after(0, lambda: self.input_entry.delete(0, tk.END))
-            self.top.after(0, lambda: self.input_entry.insert(0, self.input_file))
+            self.post(self._set_entry, self.input_entry, self.input_file)
 
             if not self.output_file:
                 input_dir = os.path.dirname(self.input_file)
                 input_name = os.path.splitext(os.path.basename(self.input_file))[0]
                 self.output_file = os.path.join(input_dir, f"{input_name}_output.xlsx")
-                self.output_entry.delete(0, tk.END)
-                self.output_entry.insert(0, self.output_file)
+                self.post(self._set_entry, self.output_entry, self.output_file)
 
+            telemetry = Telemetry("load")
             try:
-                xls = pd.ExcelFile(self.input_file)
-                sheet_names = xls.sheet_names
-
-                # Show the sheet count **immediately**
-                self.top.after(0, lambda: self.sheet_label.config(text=f"Sheets: {len(sheet_names)}"))
-
-                self.loaded_data = {sheet: pd.read_excel(xls, sheet_name=sheet) for sheet in xls.sheet_names}
+                # Keep the previous workbook's connection unless a different file is loaded
+                attached = None
+                if self.workbook is None or self.workbook.path != os.path.abspath(self.input_file):
+                    attached = {}
+                    if self.workbook is not None:
+                        # The other files of the workspace stay loaded, only the main file is replaced
+                        for alias, workbook in self.workbook.attached.items():
+                            if workbook is self.workbook:
+                                continue
+                            if workbook.path == os.path.abspath(self.input_file):
+                                workbook.close()
+                            else:
+                                attached[alias] = workbook
+                        self.workbook.close()
+                    self.workbook = Workbook(self.input_file, self.cache, self.workers, ingest)
+
+                if self.workbook.conn is not None and not rebuild:
+                    # Loading the same file again only reads the sheets that changed
+                    self.workbook.refresh(on_stage=telemetry.begin)
+                    self.sheet_columns = self.workbook.sheets
+                    self._show_sheet_count(list(self.sheet_columns))
+                    for sheet in self.sheet_columns:
+                        self._add_sheet(sheet)
+                else:
+                    # The sheet list fills in as each sheet's header is read
+                    self.sheet_columns = self.workbook.load(rebuild=rebuild, on_sheet_names=self._show_sheet_count, on_sheet=self._add_sheet,
+                                                            on_stage=telemetry.begin)
 
-                self.top.after(0, lambda: self.sheet_listbox.delete(0, tk.END))
-                for sheet in xls.sheet_names:
-                    self.top.after(0, lambda s=sheet: self.sheet_listbox.insert(tk.END, s))
+                if attached is not None:
+                    # The main file is also reachable by its own schema name, next to the files added to the workspace
+                    for alias, workbook in attached.items():
+                        self.workbook.attach(alias, workbook)
+                    self.workbook.attach(schema_alias(self.workbook.path, self.workbook.attached), self.workbook)
+                self._show_workspace_sheets()
 
                 self.done_loading = True
+                record = self._finish_telemetry(telemetry, "done", log_file, sheets=len(self.sheet_columns))
+                self.post(self.stats_label.config, text=f"Load: {format_stages(record)}", key="stats")
 
             except Exception as e:
-                self.top.after(0, lambda: messagebox.showerror("Error", f"Failed to load file: {e}"))
-                self.top.after(0, lambda: self.sheet_listbox.delete(0, tk.END))
-                self.top.after(0, lambda: self.sheet_listbox.insert(tk.END, f"Failed to load file"))
+                self._finish_telemetry(telemetry, "error", log_file, error=str(e))
+                self.post_dialog(messagebox.showerror, "Error", f"Failed to load file: {e}")
+                self.post(self._set_sheet_list, ["Failed to load file"])
+
+
+    def _show_sheet_count(self, sheet_names):
+        """Shows the sheet count and clears the sheet list for the sheets to come"""
+        self.post(self.sheet_label.config, text=f"Sheets: {len(sheet_names)}", key="sheet count")
+        self.post(self._set_sheet_list, [])
+
+
+    def _add_sheet(self, sheet):
+        """Adds a sheet to the sheet list once it is ready, sheets added in a row are inserted at once"""
+        self.post(self._insert_sheets, sheet)
+
+
+    def _insert_sheets(self, *sheets):
+        """Appends sheets to the sheet list"""
+        self.sheet_listbox.insert(tk.END, *sheets)
+
+
+    def _set_sheet_list(self, entries):
+        """Replaces the entries of the sheet list"""
+        self.sheet_listbox.delete(0, tk.END)
+        self._insert_sheets(*entries)
+
+
+    def _set_entry(self, entry, text):
+        """Replaces the text of an entry"""
+        entry.delete(0, tk.END)
+        entry.insert(0, text)
+
+
+    def _show_workspace_sheets(self):
+        """Lists the sheets of the other files in the workspace after the main file's sheets, as alias.Sheet"""
+        workspace_columns = {}
+        for alias, workbook in list(self.workbook.attached.items()):
+            if workbook is not self.workbook:
+                for sheet, columns in workbook.sheets.items():
+                    workspace_columns[f"{alias}.{sheet}"] = columns
+
+        def show():
+            for index in reversed(range(self.sheet_listbox.size())):
+                if self.sheet_listbox.get(index) in self.workspace_columns:
+                    self.sheet_listbox.delete(index)
+            self.workspace_columns = workspace_columns
+            self._insert_sheets(*workspace_columns)
+        self.post(show)
+
+
+    def _show_parsed_sheet(self, sheet, done, total):
+        """Shows parsing progress while sheets are being parsed"""
+        self.post(self.sheet_label.config, text=f"Parsed {done}/{total} sheets", key="sheet count")
+
+
+    def parse_all_sheets(self):
+        """Parses every sheet of the loaded file in the background, instead of on first use"""
+        if not self.done_loading:
+            messagebox.showerror("Error", "Please wait for data to load.")
+            return
+        threading.Thread(target=self._parse_all_sheets_thread, daemon=True).start()
+
+
+    def _parse_all_sheets_thread(self):
+        """Parses all pending sheets in worker processes"""
+        try:
+            self.workbook.ensure_sheets(set(self.sheet_columns), on_sheet=self._show_parsed_sheet)
+            self.post(self.sheet_label.config, text=f"Sheets: {len(self.sheet_columns)}", key="sheet count")
+        except Exception as e:
+            self.post_dialog(messagebox.showerror, "Error", f"Failed to parse sheets: {e}")
+
+
+    def toggle_watch(self):
+        """Starts or stops watching the input file for changes"""
+        if self.watch_file.get():
+            self.watched_stat = None
+            self.top.after(WATCH_INTERVAL, self._watch_file)
+
+
+    def _watch_file(self):
+        """Reloads the changed sheets in the background when the input file changes, checked from the Tk loop"""
+        if not self.watch_file.get():
+            return
+        if self.workbook is not None and self.done_loading and not self.query_running and not self.reloading:
+            try:
+                stat = os.stat(self.workbook.path)
+                current = (stat.st_size, stat.st_mtime)
+            except OSError:
+                current = None
+            # Only reload once the file stayed the same between two checks, it may still be being written
+            if current is not None and current == self.watched_stat and self.workbook.is_stale():
+                self.reloading = True
+                threading.Thread(target=self._reload_thread, args=(self._log_file(),), daemon=True).start()
+            self.watched_stat = current
+        self.top.after(WATCH_INTERVAL, self._watch_file)
+
+
+    def _reload_thread(self, log_file):
+        """Reloads the sheets of the input file that changed on disk"""
+        telemetry = Telemetry("reload")
+        try:
+            changed = self.workbook.refresh(on_sheet_names=self._show_sheet_count, on_sheet=self._add_sheet, on_stage=telemetry.begin)
+            if changed is not None:
+                self.sheet_columns = self.workbook.sheets
+                self._show_workspace_sheets()
+                record = self._finish_telemetry(telemetry, "done", log_file, sheets=sorted(changed))
+                self.post(self.stats_label.config, text=f"Reloaded {len(changed)} changed sheet(s): {format_stages(record)}", key="stats")
+            else:
+                # Another thread refreshed first, the run still has to end to stop its memory sampler
+                self._finish_telemetry(telemetry, "unchanged", log_file)
+        except QueryCancelled:
+            self._finish_telemetry(telemetry, "cancelled", log_file)
+        except Exception as e:
+            self._finish_telemetry(telemetry, "error", log_file, error=str(e))
+            self.post_dialog(messagebox.showerror, "Error", f"Failed to reload file: {e}")
+        finally:
+            self.reloading = False
+
+
+    def add_workspace_file(self):
+        """Adds another workbook or CSV file to the workspace, its sheets are queried as alias.Sheet"""
+        if self.workbook is None or not self.done_loading:
+            messagebox.showinfo("No File", "Please load a file first.")
+            return
+        file = filedialog.askopenfilename(title="Add File to Workspace", filetypes=INPUT_FILETYPES)
+        if file:
+            threading.Thread(target=self._add_workspace_file_thread, args=(file, self.ingest_mode.get(), self._log_file()), daemon=True).start()
+
+
+    def _add_workspace_file_thread(self, file, ingest, log_file):
+        """Loads a file into its own cache database and attaches it to the main workbook's connection"""
+        if any(workbook.path == os.path.abspath(file) for workbook in self.workbook.attached.values()):
+            self.post_dialog(messagebox.showinfo, "Workspace", "This file is already in the workspace.")
+            return
+        telemetry = Telemetry("attach")
+        try:
+            workbook = Workbook(file, self.cache, self.workers, ingest)
+            workbook.load(on_stage=telemetry.begin)
+            alias = schema_alias(file, self.workbook.attached)
+            self.workbook.attach(alias, workbook)
+            self._show_workspace_sheets()
+            record = self._finish_telemetry(telemetry, "done", log_file, sheets=len(workbook.sheets), schema=alias)
+            self.post(self.stats_label.config, text=f"Added {alias}: {format_stages(record)}", key="stats")
+        except Exception as e:
+            self._finish_telemetry(telemetry, "error", log_file, error=str(e))
+            self.post_dialog(messagebox.showerror, "Error", f"Failed to add file: {e}")
+
+
+    def remove_workspace_file(self):
+        """Removes a file added to the workspace, asking for its schema name"""
+        aliases = [alias for alias, workbook in self.workbook.attached.items() if workbook is not self.workbook] if self.workbook else []
+        if not aliases:
+            messagebox.showinfo("Workspace", "No files were added to the workspace.")
+            return
+        alias = simpledialog.askstring("Remove File", f"Schema of the file to remove ({', '.join(aliases)}):", parent=self.top)
+        if alias in aliases:
+            # Detaching waits for a running query to finish
+            threading.Thread(target=self._remove_workspace_file_thread, args=(alias,), daemon=True).start()
+        elif alias:
+            messagebox.showerror("Error", f"No file in the workspace is called {alias}.")
+
+
+    def _remove_workspace_file_thread(self, alias):
+        """Detaches a workspace file and closes its connection"""
+        try:
+            self.workbook.detach(alias).close()
+            self._show_workspace_sheets()
+        except Exception as e:
+            self.post_dialog(messagebox.showerror, "Error", f"Failed to remove file: {e}")
+
+
+    def set_workers(self):
+        """Asks for the number of worker processes used to parse sheets"""
+        workers = simpledialog.askinteger("Parser Workers", "Number of worker processes used to parse sheets:",
+                                          initialvalue=self.workers, minvalue=1, maxvalue=64, parent=self.top)
+        if workers:
+            self.workers = workers
+            if self.workbook is not None:
+                self.workbook.workers = workers
+
+
+    def set_ingest_mode(self):
+        """Switches between streaming rows with openpyxl and parsing whole sheets with pandas"""
+        if self.workbook is not None:
+            self.workbook.ingest = self.ingest_mode.get()
 
 
     def save_file(self):
-        """Select an output Excel file path"""
-        self.output_file = filedialog.asksaveasfilename(title="Select Output Excel File", defaultextension=".xlsx", filetypes=[("Excel Files", "*.xlsx")])
+        """Select an output file path, the extension picks the output format"""
+        self.output_file = filedialog.asksaveasfilename(title="Select Output File", defaultextension=".xlsx", filetypes=OUTPUT_FILETYPES)
         if self.output_file:
             self.output_entry.delete(0, tk.END)
             self.output_entry.insert(0, self.output_file)
@@ -292,11 +600,17 @@ class MainWindow:
                 messagebox.showerror("Error", f"Failed to save query: {e}")
 
 
-    def execute_query(self):
-        """Execute the SQL query on the selected input file and save the result to the output file"""
+    def execute_query(self, query=None, statements=None):
+        """Execute the SQL query on the selected input file and save the result to the output file
+
+        A script of several statements, or the statements of saved query files, runs as one batch
+        writing a sheet per statement.
+        """
         self.output_file = self.output_entry.get()
+        if statements is None:
+            statements = split_script(query or self.sql_text.get("1.0", tk.END).strip())
 
-        if not self.input_file or not self.output_file or not self.sql_text.get("1.0", tk.END).strip():
+        if not self.input_file or not self.output_file or not statements:
             messagebox.showerror("Error", "Please fill in all fields.")
             return
 
@@ -304,97 +618,270 @@ class MainWindow:
             messagebox.showerror("Error", "Please wait for data to load.")
             return
 
+        if self.query_running:
+            messagebox.showerror("Error", "Please wait for the running query to finish.")
+            return
+
         self.execution_time_label.config(text="Running: 0s")  # Reset timer display
-        self.query_start_time = time.time()  # Store start time
+        self.stats_label.config(text="")
+        self.telemetry = Telemetry("query")
 
         self.timer_running = True
-        threading.Thread(target=self._update_timer, daemon=True).start()  # Start timer in background
-        threading.Thread(target=self._run_query_thread, daemon=True).start()  # Run query in background
+        self.query_running = True  # set on the Tk thread, so a second click can't start another run
+        self.workbook.reset_cancel()
+        if len(statements) > 1:
+            names = result_names(name for name, _ in statements)
+            statements = [(name, sql) for name, (_, sql) in zip(names, statements)]
+            self._show_script_progress(names)
+            threading.Thread(target=self._run_script_thread, args=(statements, self._log_file()), daemon=True).start()
+        else:
+            # Run query in background
+            threading.Thread(target=self._run_query_thread, args=(statements[0][1], self.use_result_cache.get(), self.auto_indexes.get(), self._log_file()),
+                             daemon=True).start()
+
+
+    def run_query_files(self):
+        """Runs several saved query files as one batch, each file's result goes to its own sheet"""
+        query_files = filedialog.askopenfilenames(title="Select SQL Query Files", filetypes=[("Text Files", "*.txt")])
+        statements = []
+        for query_file in query_files:
+            with open(query_file, 'r') as file:
+                file_statements = split_script(file.read())
+            # A file with a single query is named after the file
+            if len(file_statements) == 1:
+                file_statements = [(os.path.splitext(os.path.basename(query_file))[0], file_statements[0][1])]
+            statements.extend(file_statements)
+        if statements:
+            self.execute_query(statements=statements)
 
 
     def cancel_query(self):
         """Cancels the Query"""
         if self.query_running:
             self.cancel = True
+            self.workbook.cancel()  # interrupts the running statement, parsing or writing right away
 
 
-    def _update_timer(self):
-        """Updates the timer display every second while query is running"""
-        self.elapsed = 0
-        while self.timer_running:
-            self.top.after(0, lambda t=self.elapsed: self.execution_time_label.config(text=f"Running: {t}s"))
-            time.sleep(1)
-            if not self.timer_running:
-                break
-            self.elapsed += 1
+    def post(self, function, *args, key=None, **kwargs):
+        """Queues a UI update from any thread, the Tk loop runs it with the next batch
 
-        if self.query_running:
-            self.execution_time_label.config(text=f"Done! Took: {self.elapsed}s")
-            self.query_running = False
-        else:
-            self.execution_time_label.config(text=f"Query cancelled after {self.elapsed}s")
+        Of the updates queued with the same key, like a progress label, only the last one runs.
+        """
+        self.ui_events.put((key, function, args, kwargs))
+
+
+    def post_dialog(self, function, *args):
+        """Queues a modal dialog from any thread, it opens once the batch it came with has run
 
+        A modal dialog runs its own event loop, opened within a batch it would run later batches
+        before the rest of its own.
+        """
+        self.post(self.top.after_idle, function, *args)
 
-    def _run_query_thread(self):
-        """Executes the SQL Query in a background thread to keep UI responsive"""
-        self.query_running = True
+
+    def _drain_ui_events(self):
+        """Runs the queued UI updates in one batch from the Tk loop, and updates the running time and memory"""
+        # Scheduled first, a dialog opened by an update runs its own event loop until it is closed
+        self.top.after(UI_DRAIN_INTERVAL, self._drain_ui_events)
+
+        events = []
         try:
-            conn = sqlite3.connect(":memory:")
+            while len(events) < UI_BATCH_SIZE:
+                events.append(self.ui_events.get_nowait())
+        except queue.Empty:
+            pass
+        last = {key: i for i, (key, *_) in enumerate(events) if key is not None}
+
+        sheets = []  # consecutive sheets go into the listbox with one insert
+        for i, (key, function, args, kwargs) in enumerate(events):
+            if key is not None and last[key] != i:
+                continue
+            if function == self._insert_sheets:
+                sheets.extend(args)
+                continue
+            try:
+                if sheets:
+                    self._insert_sheets(*sheets)
+                    sheets = []
+                function(*args, **kwargs)
+            except Exception:
+                self.top.report_callback_exception(*sys.exc_info())
+        if sheets:
+            self._insert_sheets(*sheets)
 
-            # Load all sheets into SQLite
-            for sheet, df in self.loaded_data.items():
-                if not self.cancel:
-                    df.to_sql(sheet, conn, if_exists="replace", index=False)
-                else:
-                    self.query_stop()
-                    return
+        self._update_status()
 
-            query = self.sql_text.get("1.0", tk.END).strip()
-            result_df = pd.read_sql_query(query, conn)
 
-            if self.cancel:
-                self.query_stop()
-                return
+    def _update_status(self):
+        """Shows the running time and stage while a query runs and the memory in use, only changed text is set"""
+        if self.timer_running:
+            stage = self.telemetry.stage()
+            text = f"Running: {int(self.telemetry.elapsed())}s" + (f" ({stage})" if stage else "")
+            if self.execution_time_label.cget("text") != text:
+                self.execution_time_label.config(text=text)
+        if time.monotonic() - self.memory_checked >= MEMORY_INTERVAL / 1000:
+            self.memory_checked = time.monotonic()
+            self.memory_label.config(text=f"Memory: {rss_bytes() / 1024 ** 2:,.0f} MB (peak {peak_rss_bytes() / 1024 ** 2:,.0f} MB)")
+
+
+    def _log_file(self):
+        """Returns the file runs are logged to, None if logging is off, read on the Tk thread and passed to the worker threads"""
+        return default_log_path() if self.log_runs.get() else None
+
 
-            result_df.to_excel(self.output_file, index=False, sheet_name="SQLResults")
-
-            # Open and adjust the workbook
-            wb = openpyxl.load_workbook(self.output_file)
-            ws = wb["SQLResults"]
-            table_ref = f"A1:{chr(64 + len(result_df.columns))}{len(result_df) + 1}"
-            table = Table(displayName="SQLTable", ref=table_ref)
-            style = TableStyleInfo(name="TableStyleMedium2", showFirstColumn=False, showLastColumn=False, showRowStripes=True, showColumnStripes=False)
-            table.tableStyleInfo = style
-            ws.add_table(table)
-
-            # Adjust column widths
-            for column in ws.columns:
-                if self.cancel:
-                    self.query_stop()
-                    return
-
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
+    def _finish_telemetry(self, telemetry, status, log_file, **details):
+        """Ends a run's telemetry and logs it to log_file if given, returns the run record"""
+        return telemetry.finish(status, log_file, **details)
+
+
+    def _finish_query(self, telemetry, status, log_file, **details):
+        """Stops the timer and shows the stage breakdown of the finished query from its own telemetry"""
+        record = self._finish_telemetry(telemetry, status, log_file, **details)
+        self.elapsed = round(record["seconds"], 1)
+        self.timer_running = False
+        self.query_running = False
+        self.workbook.reset_cancel()  # a cancel only applies to the run it was pressed for
+        if status == "done":
+            text = f"Done! Took: {self.elapsed}s{self.result_status}"
+        elif status == "cancelled":
+            text = f"Query cancelled after {self.elapsed}s"
+        else:
+            text = f"Failed after {self.elapsed}s"
+        self.post(self.execution_time_label.config, text=text, key="time")
+        self.post(self.stats_label.config, text=f"Query: {format_stages(record)}", key="stats")
+        return record
+
+
+    def _run_query_thread(self, query, use_result_cache, auto_indexes, log_file):
+        """Executes the SQL Query in a background thread to keep UI responsive, the settings are read on the Tk thread"""
+        self.result_status = ""
+        telemetry = self.telemetry
+        try:
+            # Only parse the input file again if it changed since it was loaded
+            telemetry.begin("refresh")
+            if self.workbook.refresh(on_sheet_names=self._show_sheet_count, on_sheet=self._add_sheet) is not None:
+                self.sheet_columns = self.workbook.sheets
+                self._show_workspace_sheets()
+
+            # Sheets are only parsed the first time a query reads them
+
+            # An unchanged query on unchanged sheets reuses the earlier output
+            telemetry.begin("result cache")
+            key = self.workbook.result_key(query, self.output_file) if use_result_cache else None
+            rows = self.result_cache.fetch(key, self.output_file) if key else None
+            if rows is not None:
+                self.result_status = " (cached result)"
+            else:
+                if auto_indexes:
+                    telemetry.begin("indexes")
                     try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
+                        for sheet, columns in advise(self.workbook, query):
+                            self.workbook.create_index(sheet, columns)
+                    except QueryCancelled:
+                        raise
                     except Exception as e:
-                        pass
-                ws.column_dimensions[column_letter].width = max_length + 2
+                        # Indexes only make the query faster, it still runs without them
+                        print(f"Couldn't create suggested indexes, {e}")
+
+                # Rows inserted while parsing, less the one row per sheet marking it as parsed
+                changes, pending = self.workbook.conn.total_changes, len(self.workbook.pending)
+                rows = self.workbook.run(query, lambda cursor: write_result(TimedCursor(cursor, telemetry), self.output_file),
+                                         on_sheet=self._show_parsed_sheet, on_stage=telemetry.begin)
+                telemetry.add_rows("parse", self.workbook.conn.total_changes - changes - (pending - len(self.workbook.pending)))
+                telemetry.end()
+                telemetry.add_rows("write", rows)
+                if key:
+                    telemetry.begin("result cache")
+                    self.result_cache.store(key, self.output_file, rows)
+                    self.result_status = " (cache miss)"
+
+            self.post(self.sheet_label.config, text=f"Sheets: {len(self.sheet_columns)}", key="sheet count")
+
+            record = self._finish_query(telemetry, "done", log_file, rows=rows, cached=self.result_status == " (cached result)")
+            self.post(self.show_success_dialog, record)
+
+            if self.cancel:
+                self.cancel = False
+                self.post_dialog(messagebox.showinfo, "Could not Cancel", "Query finished before it could be cancelled.")
+
+        except QueryCancelled:
+            self.post(self.sheet_label.config, text=f"Sheets: {len(self.sheet_columns)}", key="sheet count")
+            self._finish_query(telemetry, "cancelled", log_file)
+            self.query_stop()
 
-            wb.save(self.output_file)
-            wb.close()
+        except Exception as e:
+            self._finish_query(telemetry, "error", log_file, error=str(e))
+            self.post_dialog(messagebox.showerror, "Error", f"An error occurred: {e}")
 
-            self.timer_running = False
-            self.show_success_dialog()
+
+    def _run_script_thread(self, statements, log_file):
+        """Runs the statements of a script at once on read-only connections, writing one sheet per statement"""
+        self.result_status = ""
+        telemetry = self.telemetry
+        try:
+            telemetry.begin("refresh")
+            if self.workbook.refresh(on_sheet_names=self._show_sheet_count, on_sheet=self._add_sheet) is not None:
+                self.sheet_columns = self.workbook.sheets
+                self._show_workspace_sheets()
+
+            with script_writer(self.output_file) as writer:
+                def write(position, name, cursor):
+                    return writer.write(position, name, cursor, on_rows=lambda rows: self._update_script_query(position, "running", rows))
+                rows = self.workbook.run_script(statements, write, workers=self.workers, on_sheet=self._show_parsed_sheet,
+                                                on_stage=telemetry.begin, on_query=self._update_script_query)
+                telemetry.begin("write")
+            telemetry.end()
+            telemetry.add_rows("query", sum(rows))
+            self.post(self.sheet_label.config, text=f"Sheets: {len(self.sheet_columns)}", key="sheet count")
+
+            record = self._finish_query(telemetry, "done", log_file, rows=sum(rows), queries=len(statements))
+            self.post(self.show_success_dialog, record)
 
             if self.cancel:
                 self.cancel = False
-                messagebox.showinfo("Could not Cancel", "Query finished before it could be cancelled.")
+                self.post_dialog(messagebox.showinfo, "Could not Cancel", "Query finished before it could be cancelled.")
+
+        except QueryCancelled:
+            self.post(self.sheet_label.config, text=f"Sheets: {len(self.sheet_columns)}", key="sheet count")
+            self._finish_query(telemetry, "cancelled", log_file)
+            self.query_stop()
 
         except Exception as e:
-            messagebox.showerror("Error", f"An error occurred: {e}")
+            self._finish_query(telemetry, "error", log_file, error=str(e))
+            self.post_dialog(messagebox.showerror, "Error", f"An error occurred: {e}")
+
+
+    def _show_script_progress(self, names):
+        """Opens a window listing the queries of a script with their status and rows written"""
+        if self.script_window is not None and self.script_window.winfo_exists():
+            self.script_window.destroy()
+
+        self.script_window = tk.Toplevel(self.root)
+        self.script_window.geometry("500x300")
+        self.script_window.title("Script Progress")
+
+        self.script_tree = ttk.Treeview(self.script_window, columns=("status", "rows"), show="tree headings")
+        self.script_tree.heading("#0", text="Query")
+        self.script_tree.heading("status", text="Status")
+        self.script_tree.heading("rows", text="Rows")
+        self.script_tree.column("rows", anchor="e", width=100)
+        self.script_tree.pack(fill="both", expand=True, padx=10, pady=10)
+        for position, name in enumerate(names):
+            self.script_tree.insert("", tk.END, iid=str(position), text=name, values=("queued", ""))
+
+        self.apply_theme(self.script_window, self.current_theme)
+
+
+    def _update_script_query(self, position, status, detail):
+        """Shows the status of a script's query, detail is the rows written or the error message"""
+        def update():
+            if self.script_window is None or not self.script_window.winfo_exists():
+                return
+            if status == "error":
+                self.script_tree.item(str(position), values=(f"failed: {detail}", ""))
+            else:
+                self.script_tree.item(str(position), values=(status, "" if detail is None else f"{detail:,}"))
+        self.post(update, key=f"script query {position}")
 
 
     def query_stop(self):
@@ -402,19 +889,350 @@ class MainWindow:
         self.cancel = False
         self.query_running = False
         self.timer_running = False
-        messagebox.showinfo("Query Cancelled", "Query has been cancelled.")
+        self.post_dialog(messagebox.showinfo, "Query Cancelled", "Query has been cancelled.")
+
 
+    def preview_query(self):
+        """Opens a preview of the current query's result, rows are only read once they are scrolled to"""
+        query = self.sql_text.get("1.0", tk.END).strip()
+        if not self.done_loading or not query:
+            messagebox.showerror("Error", "Please load a file and enter a query first.")
+            return
+        if self.query_running:
+            messagebox.showerror("Error", "Please wait for the running query to finish.")
+            return
+
+        self._close_preview()
+        self.preview_generation += 1
+
+        self.preview_window = tk.Toplevel(self.root)
+        self.preview_window.geometry("800x500")
+        self.preview_window.title("Result Preview")
+        self.preview_window.protocol("WM_DELETE_WINDOW", self._close_preview)
+
+        self.preview_label = tk.Label(self.preview_window, text="Running query...", anchor="w")
+        self.preview_label.pack(fill="x", padx=10, pady=(10, 0))
+
+        # Only the visible rows are in the tree, the scrollbar is driven by the row offset instead of the tree
+        tree_frame = tk.Frame(self.preview_window)
+        tree_frame.pack(fill="both", expand=True, padx=10, pady=5)
+        self.preview_tree = ttk.Treeview(tree_frame, show="headings", height=PREVIEW_ROWS, selectmode="extended")
+        self.preview_scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self._scroll_preview)
+        x_scrollbar = ttk.Scrollbar(tree_frame, orient="horizontal", command=self.preview_tree.xview)
+        self.preview_tree.configure(xscrollcommand=x_scrollbar.set)
+        self.preview_tree.grid(row=0, column=0, sticky="nsew")
+        self.preview_scrollbar.grid(row=0, column=1, sticky="ns")
+        x_scrollbar.grid(row=1, column=0, sticky="ew")
+        tree_frame.grid_rowconfigure(0, weight=1)
+        tree_frame.grid_columnconfigure(0, weight=1)
+
+        self.preview_tree.bind("<MouseWheel>", lambda event: self._scroll_preview("scroll", -3 if event.delta > 0 else 3, "units"))
+        self.preview_tree.bind("<Button-4>", lambda event: self._scroll_preview("scroll", -3, "units"))
+        self.preview_tree.bind("<Button-5>", lambda event: self._scroll_preview("scroll", 3, "units"))
+        self.preview_tree.bind("<Prior>", lambda event: self._scroll_preview("scroll", -1, "pages"))
+        self.preview_tree.bind("<Next>", lambda event: self._scroll_preview("scroll", 1, "pages"))
+
+        # Writing the whole result stays an explicit action
+        tk.Button(self.preview_window, text="Export Result", command=lambda: self.execute_query(query)).pack(anchor="e", padx=10, pady=(0, 10))
+
+        self.apply_theme(self.preview_window, self.current_theme)
+        self.preview_offset = 0
+        self.preview_loading = True
+        threading.Thread(target=self._open_preview_thread, args=(query, self.preview_generation), daemon=True).start()
+
+
+    def _open_preview_thread(self, query, generation):
+        """Parses the sheets the query reads if needed and reads the first rows"""
+        try:
+            pager = self.workbook.pager(query)
+            rows = pager.rows(0, PREVIEW_ROWS)
+        except Exception as e:
+            self.post(self._show_preview_error, e, generation)
+            return
+        self.post(self._show_preview, pager, 0, rows, generation)
+
+
+    def _show_preview(self, pager, offset, rows, generation):
+        """Shows a page of preview rows and fetches the next one if the view was scrolled meanwhile"""
+        if generation != self.preview_generation or self.preview_window is None or not self.preview_window.winfo_exists():
+            pager.close()
+            return
+        self.preview_loading = False
+
+        if pager is not self.preview_pager:
+            self.preview_pager = pager
+            columns = [f"#{i}" for i in range(len(pager.columns))]
+            self.preview_tree.configure(columns=columns)
+            for column, name in zip(columns, pager.columns):
+                self.preview_tree.heading(column, text=name)
+                self.preview_tree.column(column, width=max(80, len(str(name)) * 9), stretch=False)
+
+        self.preview_tree.delete(*self.preview_tree.get_children())
+        for row in rows:
+            self.preview_tree.insert("", tk.END, values=["" if value is None else value for value in row])
+
+        total, complete = pager.known_rows()
+        self.preview_scrollbar.set(offset / max(total, 1), min(1.0, (offset + len(rows)) / max(total, 1)))
+        shown = f"{offset + 1:,}-{offset + len(rows):,}" if rows else "0"
+        self.preview_label.config(text=f"Rows {shown} of {total:,}{'' if complete else '+'}")
+
+        if self.preview_offset != offset:
+            self._request_preview_rows()
+
+
+    def _show_preview_error(self, error, generation):
+        """Shows why the preview couldn't be read"""
+        if generation != self.preview_generation:
+            return
+        self.preview_loading = False
+        if self.preview_window is not None and self.preview_window.winfo_exists():
+            self.preview_label.config(text=f"Could not preview query: {error}")
+
+
+    def _scroll_preview(self, action, amount=0, unit="units"):
+        """Moves the preview to another row offset, from the scrollbar, mouse wheel or page keys"""
+        if self.preview_pager is None:
+            return
+        total, complete = self.preview_pager.known_rows()
+        if action == "moveto":
+            offset = int(float(amount) * total)
+        else:
+            offset = self.preview_offset + int(amount) * (PREVIEW_ROWS if unit == "pages" else 1)
+        if complete:
+            offset = min(offset, total - PREVIEW_ROWS)
+        self.preview_offset = max(0, offset)
+        self._request_preview_rows()
+
+
+    def _request_preview_rows(self):
+        """Reads the rows at the preview offset in the background, one read at a time"""
+        if self.preview_loading or self.preview_pager is None:
+            return
+        self.preview_loading = True
+        pager, offset, generation = self.preview_pager, self.preview_offset, self.preview_generation
 
-    def show_success_dialog(self):
-        """Shows a success dialog with a button to open the output file"""
+        def read():
+            try:
+                rows = pager.rows(offset, PREVIEW_ROWS)
+            except Exception as e:
+                self.post(self._show_preview_error, e, generation)
+                return
+            self.post(self._show_preview, pager, offset, rows, generation)
+        threading.Thread(target=read, daemon=True).start()
+
+
+    def _close_preview(self):
+        """Closes the preview window and its connection"""
+        if self.preview_pager is not None:
+            self.preview_pager.close()
+            self.preview_pager = None
+        if self.preview_window is not None and self.preview_window.winfo_exists():
+            self.preview_window.destroy()
+
+
+    def show_profiler(self):
+        """Opens a window with the query plan of the current query, where a profiled run can be started"""
+        query = self.sql_text.get("1.0", tk.END).strip()
+        if not self.done_loading or not query:
+            messagebox.showerror("Error", "Please load a file and enter a query first.")
+            return
+
+        # Explaining waits for a running query or parse to release the workbook
+        threading.Thread(target=self._explain_thread, args=(query,), daemon=True).start()
+
+
+    def _explain_thread(self, query):
+        """Explains the query in the background and opens the profiler window with its plan"""
+        try:
+            plan = explain(self.workbook, query)
+        except Exception as e:
+            self.post_dialog(messagebox.showerror, "Error", f"Could not explain query: {e}")
+            return
+        self.post(self._show_profiler, query, plan)
+
+
+    def _show_profiler(self, query, plan):
+        """Opens the profiler window with the query plan"""
+        if self.profiler_window is not None and self.profiler_window.winfo_exists():
+            self.profiler_window.destroy()
+
+        self.profiler_window = tk.Toplevel(self.root)
+        self.profiler_window.geometry("650x450")
+        self.profiler_window.title("Explain / Profile")
+
+        tk.Label(self.profiler_window, text="Query plan (full scans and temporary B-trees are highlighted):").pack(anchor="w", padx=10, pady=(10, 0))
+        plan_tree = ttk.Treeview(self.profiler_window, columns=("warning",), height=8)
+        plan_tree.heading("#0", text="Step")
+        plan_tree.heading("warning", text="Warning")
+        plan_tree.column("#0", width=450)
+        plan_tree.column("warning", width=120)
+        plan_tree.tag_configure("warning", background="#f4c7a1", foreground="#000000")
+        plan_tree.pack(fill="both", expand=True, padx=10)
+        for node, parent, detail, warning in plan:
+            plan_tree.insert(parent if plan_tree.exists(parent) else "", tk.END, iid=node, text=detail, values=(warning or "",),
+                             tags=("warning",) if warning else (), open=True)
+
+        button_frame = tk.Frame(self.profiler_window)
+        button_frame.pack(fill="x", padx=10, pady=5)
+        self.profile_run_button = tk.Button(button_frame, text="Profile Run", command=lambda: self.start_profile(query))
+        self.profile_run_button.pack(side="left")
+        tk.Button(button_frame, text="Cancel", command=self.cancel_profile).pack(side="left", padx=5)
+        self.profile_label = tk.Label(button_frame, text="Runs the query without writing the output")
+        self.profile_label.pack(side="left", padx=5)
+
+        columns = ("seconds", "rows", "rows_per_second", "vm_steps", "peak_rss_mb")
+        self.profile_tree = ttk.Treeview(self.profiler_window, columns=columns, height=4)
+        self.profile_tree.heading("#0", text="Phase")
+        for column, heading in zip(columns, ("Time (s)", "Rows", "Rows/s", "VM Steps", "Peak MB")):
+            self.profile_tree.heading(column, text=heading)
+            self.profile_tree.column(column, width=90, anchor="e")
+        self.profile_tree.column("#0", width=120)
+        self.profile_tree.pack(fill="x", padx=10, pady=(0, 10))
+
+        self.apply_theme(self.profiler_window, self.current_theme)
+
+
+    def start_profile(self, query):
+        """Starts a profiled run of the query in the background"""
+        self.profile_run_button.config(state="disabled")
+        self.profile_label.config(text="Running...")
+        self.profile_tree.delete(*self.profile_tree.get_children())
+        self.profiling = True
+        self.workbook.reset_cancel()
+        threading.Thread(target=self._profile_thread, args=(query, self._log_file()), daemon=True).start()
+
+
+    def cancel_profile(self):
+        """Cancels the profiled run"""
+        if self.profiling:
+            self.workbook.cancel()
+
+
+    def _profile_thread(self, query, log_file):
+        """Runs the query with VM step counting, it may have to parse sheets first"""
+        try:
+            record = profile(self.workbook, query, log_file)
+        except QueryCancelled:
+            record = "Profile run cancelled"
+        except Exception as e:
+            record = f"Profile run failed: {e}"
+        self.profiling = False
+        self.workbook.reset_cancel()
+        self.post(self._show_profile, record)
+
+
+    def _show_profile(self, record):
+        """Fills the phase table of the profiler window"""
+        if self.profiler_window is None or not self.profiler_window.winfo_exists():
+            return
+        self.profile_run_button.config(state="normal")
+        if isinstance(record, str):
+            self.profile_label.config(text=record)
+            return
+
+        for stage in record["stages"]:
+            values = (f"{stage['seconds']:.3f}", f"{stage['rows']:,}" if stage["rows"] is not None else "",
+                      f"{stage['rows_per_second']:,}" if stage["rows_per_second"] else "",
+                      f"{record['vm_steps'].get(stage['stage'], 0):,}", f"{stage['peak_rss_mb']:,.0f}")
+            self.profile_tree.insert("", tk.END, text=stage["stage"], values=values)
+        self.profile_label.config(text=f"{record['rows']:,} rows in {record['seconds']:.3f}s, "
+                                       f"{sum(record['vm_steps'].values()):,} VM steps")
+
+
+    def show_index_advisor(self):
+        """Opens a window listing suggested indexes for the current query and the existing ones"""
+        query = self.sql_text.get("1.0", tk.END).strip()
+        if not self.done_loading or not query:
+            messagebox.showerror("Error", "Please load a file and enter a query first.")
+            return
+
+        if self.advisor_window is not None and self.advisor_window.winfo_exists():
+            self.advisor_window.destroy()
+
+        self.advisor_window = tk.Toplevel(self.root)
+        self.advisor_window.geometry("500x350")
+        self.advisor_window.title("Index Advisor")
+
+        tk.Label(self.advisor_window, text="Suggested indexes for the current query:").pack(anchor="w", padx=10, pady=(10, 0))
+        self.suggested_listbox = tk.Listbox(self.advisor_window, height=6, selectmode=tk.EXTENDED)
+        self.suggested_listbox.pack(fill="x", padx=10)
+        self.suggested_listbox.insert(tk.END, "Analyzing query...")
+        tk.Button(self.advisor_window, text="Create Selected", command=self.create_selected_indexes).pack(anchor="e", padx=10, pady=5)
+
+        tk.Label(self.advisor_window, text="Existing indexes:").pack(anchor="w", padx=10)
+        self.existing_listbox = tk.Listbox(self.advisor_window, height=6, selectmode=tk.EXTENDED)
+        self.existing_listbox.pack(fill="x", padx=10)
+        tk.Button(self.advisor_window, text="Drop Selected", command=self.drop_selected_indexes).pack(anchor="e", padx=10, pady=5)
+
+        self.apply_theme(self.advisor_window, self.current_theme)
+        self.suggested_indexes = []
+        threading.Thread(target=self._index_advisor_thread, args=(query,), daemon=True).start()
+
+
+    def _index_advisor_thread(self, query):
+        """Finds suggested indexes in the background, it may have to parse sheets first"""
+        try:
+            suggestions = advise(self.workbook, query)
+        except Exception as e:
+            self.post_dialog(messagebox.showerror, "Error", f"Could not analyze query: {e}")
+            suggestions = []
+        self.post(self._show_indexes, suggestions, self.workbook.indexes())
+
+
+    def _show_indexes(self, suggestions, existing):
+        """Fills the index advisor lists, existing are the indexes read by the worker thread"""
+        if not self.advisor_window.winfo_exists():
+            return
+        self.suggested_indexes = suggestions
+        self.suggested_listbox.delete(0, tk.END)
+        for sheet, columns in suggestions:
+            self.suggested_listbox.insert(tk.END, f"{sheet} ({', '.join(columns)})")
+        if not suggestions:
+            self.suggested_listbox.insert(tk.END, "No indexes needed for this query")
+
+        self.existing_indexes = existing
+        self.existing_listbox.delete(0, tk.END)
+        for name, sheet, columns in self.existing_indexes:
+            self.existing_listbox.insert(tk.END, f"{sheet} ({', '.join(columns)})")
+
+
+    def create_selected_indexes(self):
+        """Creates the selected suggested indexes"""
+        selected = [self.suggested_indexes[i] for i in self.suggested_listbox.curselection() if i < len(self.suggested_indexes)]
+        threading.Thread(target=self._change_indexes_thread, args=(selected, []), daemon=True).start()
+
+
+    def drop_selected_indexes(self):
+        """Drops the selected existing indexes"""
+        selected = [self.existing_indexes[i][0] for i in self.existing_listbox.curselection()]
+        threading.Thread(target=self._change_indexes_thread, args=([], selected), daemon=True).start()
+
+
+    def _change_indexes_thread(self, create, drop):
+        """Creates and drops indexes in the background, building an index on a big sheet takes a while"""
+        try:
+            for sheet, columns in create:
+                self.workbook.create_index(sheet, columns)
+            for name in drop:
+                self.workbook.drop_index(name)
+        except Exception as e:
+            self.post_dialog(messagebox.showerror, "Error", f"Could not change indexes: {e}")
+        remaining = [suggestion for suggestion in self.suggested_indexes if suggestion not in create]
+        self.post(self._show_indexes, remaining, self.workbook.indexes())
+
+
+    def show_success_dialog(self, record):
+        """Shows a success dialog with the stage breakdown and a button to open the output file"""
         self.dialog = tk.Toplevel(self.root)
-        self.dialog.geometry("300x100")
         self.dialog.title("Execution Complete")
         self.dialog.focus()
 
         success_label = tk.Label(self.dialog, text=f"Query executed successfully!\nTook {self.elapsed} seconds")
         success_label.pack(pady=0)
 
+        stats_label = tk.Label(self.dialog, text=format_stages(record, separator="\n"), justify="left")
+        stats_label.pack(padx=20, pady=5)
+
         open_button = tk.Button(self.dialog, text="Open Output File", width=15, command=self.open_output_file)
         open_button.pack(side="left", pady=0, padx=20)
 
@@ -443,8 +1261,8 @@ class MainWindow:
             self.column_listbox.delete(0, tk.END)
 
             # Fetch columns of the selected sheet
-            if selected_sheet in self.loaded_data:
-                columns = self.loaded_data[selected_sheet].columns
+            columns = self.sheet_columns.get(selected_sheet, self.workspace_columns.get(selected_sheet))
+            if columns:
                 for column in columns:
                     self.column_listbox.insert(tk.END, column)  # Insert each column into the column listbox
         except Exception as e:
@@ -531,4 +1349,9 @@ def start_up():
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # worker processes in the packaged .exe
+    if len(sys.argv) > 1:
+        # Arguments run queries without the GUI, see batch.py
+        import batch
+        sys.exit(batch.main())
     start_up()
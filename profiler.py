@@ -0,0 +1,56 @@
+#  -*- coding: utf-8 -*-
+"""Showing how SQLite runs a query: its plan, and the VM steps, rows and time of a profiled run"""
+from advisor import query_plan
+from engine import PROGRESS_INTERVAL
+from telemetry import Telemetry
+from writers import FETCH_SIZE
+
+
+def plan_warning(detail):
+    """Returns what makes a query plan step slow on big sheets, None for steps that are fine"""
+    if "TEMP B-TREE" in detail:
+        return "temp b-tree"  # sorts or groups the rows in a temporary table
+    if "AUTOMATIC" in detail:
+        return "automatic index"  # built again on every run
+    if detail.startswith("SCAN ") and not detail.startswith("SCAN CONSTANT ROW"):
+        return "full scan"
+    return None
+
+
+def explain(workbook, sql):
+    """Returns the EXPLAIN QUERY PLAN of a query as [(id, parent, detail, warning)], without parsing any sheets"""
+    with workbook.lock:
+        return [(node, parent, detail, plan_warning(detail)) for node, parent, detail in query_plan(workbook.conn, sql)]
+
+
+def profile(workbook, sql, log_file=None):
+    """Runs a query without writing its result and returns its run record
+
+    The record has the time, rows and peak memory of each phase (parsing the sheets the query reads,
+    running to the first row, reading the remaining rows) and "vm_steps" with the SQLite VM steps of
+    each phase, counted to the nearest PROGRESS_INTERVAL.
+    """
+    telemetry = Telemetry("profile")
+    steps = {}
+
+    def count_steps():
+        stage = telemetry.stage()
+        steps[stage] = steps.get(stage, 0) + PROGRESS_INTERVAL
+
+    def read_rows(cursor):
+        telemetry.begin("rows")
+        rows = 0
+        batch = cursor.fetchmany(FETCH_SIZE)
+        while batch:
+            rows += len(batch)
+            batch = cursor.fetchmany(FETCH_SIZE)
+        telemetry.end(rows)
+        return rows
+
+    try:
+        rows = workbook.run(sql, read_rows, on_stage=lambda stage: telemetry.begin("first row" if stage == "query" else stage),
+                            on_progress=count_steps)
+    except BaseException:
+        telemetry.finish("failed")
+        raise
+    return telemetry.finish("done", log_file, rows=rows, vm_steps=steps)
@@ -0,0 +1,207 @@
+#  -*- coding: utf-8 -*-
+"""Timing the stages of a load or query run, with their row rates and peak memory"""
+import ctypes
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from cache import default_cache_dir
+
+SAMPLE_INTERVAL = 0.01
+LOG_FILE = "runs.jsonl"
+
+
+def _windows_memory_counters():
+    """Returns the PROCESS_MEMORY_COUNTERS of this process on Windows"""
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+    return counters
+
+
+def rss_bytes():
+    """Returns the resident memory of this process in bytes, 0 if it can't be determined"""
+    if os.name == 'nt':
+        return _windows_memory_counters().WorkingSetSize
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def peak_rss_bytes():
+    """Returns the highest resident memory of this process since it started in bytes, 0 if it can't be determined"""
+    if os.name == 'nt':
+        return _windows_memory_counters().PeakWorkingSetSize
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macOS, KB elsewhere
+    except (ImportError, OSError):
+        return 0
+
+
+def default_log_path():
+    """Returns the JSON lines file runs are logged to"""
+    return os.path.join(default_cache_dir(), LOG_FILE)
+
+
+class MemorySampler:
+    """Samples the resident memory in a background thread to find the peak of a stage"""
+
+    def __enter__(self):
+        self.peak = rss_bytes()
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, rss_bytes())
+            time.sleep(SAMPLE_INTERVAL)
+
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+class Telemetry:
+    """Records the stages of one run, begin() ends the running stage and starts the next one
+
+    Beginning a stage that ran before adds to it, so interleaved stages like fetching and writing
+    a result batch by batch add up to one entry each.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.stages = {}
+        self.current = None
+        self.started = time.perf_counter()
+        self.stage_started = self.started
+        self.peak = 0
+        self.sampler = MemorySampler().__enter__()
+
+
+    def begin(self, name):
+        """Starts a stage, ending the one that is running"""
+        self.end()
+        self.current = self.stages.setdefault(name, {"stage": name, "seconds": 0.0, "rows": None, "peak_rss": 0})
+        self.stage_started = time.perf_counter()
+        self.sampler.peak = rss_bytes()
+
+
+    def end(self, rows=None):
+        """Ends the running stage, rows adds to the rows it processed"""
+        if self.current is None:
+            return
+        self.current["seconds"] += time.perf_counter() - self.stage_started
+        self.current["peak_rss"] = max(self.current["peak_rss"], self.sampler.peak, rss_bytes())
+        if rows is not None:
+            self.current["rows"] = (self.current["rows"] or 0) + rows
+        self.peak = max(self.peak, self.current["peak_rss"])
+        self.current = None
+
+
+    def add_rows(self, name, rows):
+        """Adds rows to a stage, also after it ended"""
+        stage = self.stages.get(name)
+        if stage is not None:
+            stage["rows"] = (stage["rows"] or 0) + rows
+
+
+    def stage(self):
+        """Returns the name of the running stage, None between stages"""
+        return self.current["stage"] if self.current else None
+
+
+    def elapsed(self):
+        """Returns the seconds since the run started"""
+        return time.perf_counter() - self.started
+
+
+    def finish(self, status="done", log_file=None, **details):
+        """Ends the run and appends it to the JSON lines log_file if given, returns the record"""
+        self.end()
+        self.sampler.__exit__()
+        record = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "run": self.run,
+            "status": status,
+            "seconds": round(self.elapsed(), 3),
+            "peak_rss_mb": round(max(self.peak, self.sampler.peak) / 1024 ** 2, 1),
+            "stages": [{"stage": stage["stage"], "seconds": round(stage["seconds"], 3), "rows": stage["rows"],
+                        "rows_per_second": round(stage["rows"] / stage["seconds"]) if stage["rows"] and stage["seconds"] else None,
+                        "peak_rss_mb": round(stage["peak_rss"] / 1024 ** 2, 1)} for stage in self.stages.values()],
+            **details,
+        }
+        if log_file:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+                with open(log_file, 'a', encoding='utf-8') as file:
+                    file.write(json.dumps(record) + "\n")
+            except OSError as e:
+                print(f"Couldn't write run log {log_file}, {e}")
+        return record
+
+
+class TimedCursor:
+    """Wraps a cursor so the time spent fetching counts as the query stage and the rest as the write stage"""
+
+    def __init__(self, cursor, telemetry, query_stage="query", write_stage="write"):
+        self.cursor = cursor
+        self.telemetry = telemetry
+        self.query_stage = query_stage
+        self.write_stage = write_stage
+
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+
+    def _fetch(self, fetch, *args):
+        self.telemetry.begin(self.query_stage)
+        rows = fetch(*args)
+        self.telemetry.end(len(rows))
+        self.telemetry.begin(self.write_stage)
+        return rows
+
+
+    def fetchmany(self, size=None):
+        return self._fetch(self.cursor.fetchmany, size or self.cursor.arraysize)
+
+
+    def fetchall(self):
+        return self._fetch(self.cursor.fetchall)
+
+
+def format_stages(record, separator=" | "):
+    """Formats a run record as one entry per stage, for showing in the UI"""
+    parts = []
+    for stage in record["stages"]:
+        part = f"{stage['stage']} {stage['seconds']:.2f}s"
+        if stage["rows_per_second"]:
+            part += f" ({stage['rows']:,} rows, {stage['rows_per_second']:,}/s)"
+        parts.append(part)
+    parts.append(f"peak {record['peak_rss_mb']:,.0f} MB")
+    return separator.join(parts)
@@ -0,0 +1,24 @@
+#  -*- coding: utf-8 -*-
+import os
+import sys
+import openpyxl
+import pytest
+
+# The modules live next to main.py, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_workbook(tmp_path):
+    """Returns a function writing {sheet: rows} to an xlsx file in tmp_path, the first row is the header"""
+    def make(sheets, name="book.xlsx"):
+        path = tmp_path / name
+        wb = openpyxl.Workbook()
+        wb.remove(wb.active)
+        for sheet, rows in sheets.items():
+            ws = wb.create_sheet(sheet)
+            for row in rows:
+                ws.append(row)
+        wb.save(path)
+        return str(path)
+    return make
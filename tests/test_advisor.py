@@ -0,0 +1,33 @@
+#  -*- coding: utf-8 -*-
+import pytest
+from advisor import advise
+from cache import WorkbookCache
+from engine import Workbook, schema_alias
+
+
+@pytest.fixture
+def workspace(tmp_path, make_workbook):
+    rows = [["id", "cust"]] + [[i, i % 17] for i in range(100)]
+    cache = WorkbookCache(str(tmp_path / "cache"))
+    main = Workbook(make_workbook({"Sales 2024": rows}, "main.xlsx"), cache, workers=1)
+    jan = Workbook(make_workbook({"Sales 2024": rows}, "jan.xlsx"), cache, workers=1)
+    main.load()
+    jan.load()
+    main.attach("jan", jan)
+    main.attach(schema_alias(main.path, main.attached), main)
+    yield main
+    jan.close()
+    main.close()
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM Sales_2024 WHERE cust = 3",
+    'SELECT * FROM main_2."Sales 2024" WHERE cust = 3',
+    "SELECT * FROM Sales_2024 a JOIN jan.Sales_2024 b ON a.cust = b.cust",
+])
+def test_advise_through_views_and_schemas(workspace, sql):
+    assert advise(workspace, sql) == [("Sales 2024", ["cust"])]
+
+
+def test_advise_never_indexes_attached_files(workspace):
+    assert advise(workspace, "SELECT * FROM jan.Sales_2024 WHERE cust = 3") == []
@@ -0,0 +1,42 @@
+#  -*- coding: utf-8 -*-
+import os
+import pytest
+from batch import main, run_batch
+
+
+@pytest.fixture
+def queries(tmp_path, monkeypatch):
+    """Writes a working and a failing query file, the workbook cache goes to tmp_path"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("LOCALAPPDATA", str(tmp_path / "cache"))
+    good, bad = tmp_path / "good.txt", tmp_path / "bad.txt"
+    good.write_text("SELECT * FROM S")
+    bad.write_text("SELECT * FROM Missing")
+    return str(good), str(bad)
+
+
+def test_exit_status(tmp_path, make_workbook, queries):
+    input_file = make_workbook({"S": [["x"], [1]]})
+    good, bad = queries
+    output_dir = str(tmp_path / "out")
+    assert main(["-i", input_file, "-q", good, "-o", output_dir, "-f", "csv", "-p", "1"]) == 0
+    assert os.listdir(output_dir) == ["book_good.csv"]
+    assert main(["-i", input_file, "-q", good, bad, "-o", output_dir, "-f", "csv", "-p", "1"]) == 1
+
+
+def test_same_workbook_runs_once(tmp_path, make_workbook, queries, monkeypatch):
+    input_file = make_workbook({"S": [["x"], [1]]})
+    monkeypatch.chdir(tmp_path)
+    results = run_batch([input_file, os.path.join(".", "book.xlsx")], queries[:1], output_format="csv", processes=1)
+    assert [(output_file, rows, error) for _, output_file, rows, error in results] == [(str(tmp_path / "book_good.csv"), 1, None)]
+
+
+def test_colliding_outputs_fail_before_running(tmp_path, make_workbook, queries):
+    os.makedirs(tmp_path / "a")
+    os.makedirs(tmp_path / "b")
+    first = make_workbook({"S": [["x"], [1]]}, os.path.join("a", "x.xlsx"))
+    second = make_workbook({"S": [["x"], [2]]}, os.path.join("b", "x.xlsx"))
+    output_dir = tmp_path / "out"
+    with pytest.raises(ValueError, match="x_good.csv"):
+        run_batch([first, second], queries[:1], str(output_dir), "csv", processes=1)
+    assert not output_dir.exists()
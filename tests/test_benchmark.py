@@ -0,0 +1,37 @@
+#  -*- coding: utf-8 -*-
+import os
+from benchmark import _parse_threshold, compare, generate_workbook, run_pipeline
+
+
+def _results(seconds, peak_rss_mb):
+    return {"pipelines": {"stream": {"ingest": {"seconds": seconds, "peak_rss_mb": peak_rss_mb}}}}
+
+
+def test_parse_threshold():
+    thresholds = {"default": 0.2}
+    _parse_threshold("0.1", thresholds)
+    _parse_threshold("ingest=0.5", thresholds)
+    assert thresholds == {"default": 0.1, "ingest": 0.5}
+
+
+def test_compare_uses_the_stage_threshold():
+    baseline = _results(1.0, 100)
+    assert compare(_results(1.15, 100), baseline, {"default": 0.2}) == []
+    assert compare(_results(1.25, 100), baseline, {"default": 0.2}) == \
+        ["stream.ingest.seconds: 1.0 -> 1.25 (+25%, allowed +20%)"]
+    assert compare(_results(1.25, 100), baseline, {"default": 0.2, "ingest": 0.3}) == []
+    assert compare(_results(1.0, 150), baseline, {"default": 0.2, "ingest": 0.3}) == \
+        ["stream.ingest.peak_rss_mb: 100 -> 150 (+50%, allowed +30%)"]
+
+
+def test_compare_skips_stages_missing_from_the_baseline():
+    assert compare(_results(5.0, 500), {"pipelines": {"pandas": {}}}, {"default": 0.2}) == []
+
+
+def test_run_pipeline(tmp_path):
+    input_file = str(tmp_path / "bench.xlsx")
+    generate_workbook(input_file, sheets=1, rows=20, columns=3)
+    stages = run_pipeline("stream", input_file, str(tmp_path / "out.xlsx"), "SELECT * FROM Sheet1")
+    assert list(stages) == ["load", "ingest", "query_write"]
+    assert stages["ingest"]["rows"] == 20
+    assert os.path.exists(tmp_path / "out.xlsx")
@@ -0,0 +1,43 @@
+#  -*- coding: utf-8 -*-
+import os
+from cache import WorkbookCache
+from engine import Workbook
+
+
+def _load(path, cache, rebuild=False):
+    """Loads a workbook and closes it again, returns the path of its cache database"""
+    workbook = Workbook(path, cache, workers=1)
+    workbook.load(rebuild=rebuild)
+    workbook.close()
+    return workbook.db_path
+
+
+def test_least_recently_used_workbook_is_evicted(tmp_path, make_workbook):
+    cache = WorkbookCache(str(tmp_path / "cache"))
+    first, second, third = (make_workbook({"S": [["x"], [i]]}, f"{name}.xlsx") for i, name in enumerate(("a", "b", "c")))
+    first_db = _load(first, cache)
+    second_db = _load(second, cache)
+    cache.size_limit = os.path.getsize(first_db) * 2.5  # room for two of them
+
+    assert cache.lookup(first)[0] == first_db  # first is now used more recently than second
+    third_db = _load(third, cache)
+    assert os.path.exists(first_db) and os.path.exists(third_db)
+    assert not os.path.exists(second_db)
+    assert cache.lookup(second)[0] is None
+
+
+def test_load_reuses_the_cache_until_rebuilt(tmp_path, make_workbook):
+    cache = WorkbookCache(str(tmp_path / "cache"))
+    path = make_workbook({"S": [["x"], [1]]})
+    workbook = Workbook(path, cache, workers=1)
+    workbook.load()
+    workbook.conn.execute("CREATE TABLE marker (x)")
+    workbook.conn.commit()
+    try:
+        workbook.load()
+        assert workbook.conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'marker'").fetchone() == (1,)
+        workbook.load(rebuild=True)
+        assert workbook.conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'marker'").fetchone() == (0,)
+        assert workbook.run("SELECT x FROM S", lambda cursor: cursor.fetchall()) == [(1,)]
+    finally:
+        workbook.close()
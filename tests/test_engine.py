@@ -0,0 +1,221 @@
+#  -*- coding: utf-8 -*-
+import datetime
+import sqlite3
+import threading
+import time
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+from cache import WorkbookCache
+from engine import (QueryCancelled, ResultPager, Workbook, bulk_store_sheet, changed_sheets, compact_column, create_cache_db,
+                    parse_sheet, store_sheet, stream_sheet)
+from writers import write_result
+
+# Whole numbers, dates and numbers first, values that don't fit their first batch later
+PARITY_ROWS = [
+    ["price", "code", "day", "late", "count"],
+    [3, 1, datetime.datetime(2020, 1, 1), None, 1],
+    [4, 2, datetime.datetime(2020, 1, 2), None, 2.0],
+    [2.5, "x", datetime.datetime(2020, 1, 3, 10, 30), "t", 3],
+    [None, 7, None, 5, None],
+]
+
+
+def _ingest(mode, input_file, sheet):
+    conn = sqlite3.connect(":memory:")
+    if mode == "stream":
+        stream_sheet(conn, input_file, sheet, batch_size=2)
+    elif mode == "bulk":
+        bulk_store_sheet(conn, sheet, *parse_sheet(input_file, sheet))
+    else:
+        store_sheet(conn, sheet, *parse_sheet(input_file, sheet))
+    conn.commit()
+    return conn
+
+
+def test_ingest_modes_store_the_same_values(make_workbook):
+    input_file = make_workbook({"S": PARITY_ROWS})
+    query = "SELECT price / 2, typeof(code), code, day, late, count, typeof(count) FROM S ORDER BY rowid"
+    results = {mode: _ingest(mode, input_file, "S").execute(query).fetchall() for mode in ("stream", "bulk", "pandas")}
+    assert results["stream"] == results["bulk"] == results["pandas"]
+    assert results["stream"][0] == (1.5, "text", "1", "2020-01-01 00:00:00", None, 1, "integer")
+
+
+def test_csv_ingest_modes_store_the_same_values(tmp_path):
+    input_file = tmp_path / "codes.csv"
+    input_file.write_text("code,n,price,empty,name\n007,1,1,,a\n10,,2.5,,b\n,3,3,,\n")
+    query = "SELECT code, typeof(code), n, typeof(n), price, empty, name FROM codes ORDER BY rowid"
+    results = {mode: _ingest(mode, str(input_file), "codes").execute(query).fetchall() for mode in ("stream", "bulk", "pandas")}
+    assert results["stream"] == results["bulk"] == results["pandas"]
+    assert [row[:4] for row in results["stream"]] == [("007", "text", 1, "integer"), ("10", "text", None, "null"), (None, "null", 3, "integer")]
+
+
+def test_stream_keeps_types_of_consistent_columns(make_workbook):
+    input_file = make_workbook({"S": [["n", "day"], [1, datetime.datetime(2020, 1, 1)], [2.0, datetime.datetime(2020, 1, 2)], [3, None]]})
+    conn = _ingest("stream", input_file, "S")
+    assert conn.execute("SELECT type FROM pragma_table_info('S')").fetchall() == [("INTEGER",), ("DATE",)]
+    assert conn.execute("SELECT n, day FROM S").fetchall() == [(1, "2020-01-01"), (2, "2020-01-02"), (3, None)]
+
+
+@pytest.mark.parametrize("values, dtype, expected", [
+    ([1.0, None, 3.0], "Int8", [1, None, 3]),  # whole numbers with empty cells, read by pandas as floats
+    ([1, 2, 300], "int16", [1, 2, 300]),
+    ([1.5, 2.0], "float64", [1.5, 2.0]),
+    ([2.0 ** 60, 1.0], "float64", [2.0 ** 60, 1.0]),  # too large for a float to hold every whole number exactly
+    (pd.to_datetime(["2020-01-01", None]), "object", [datetime.date(2020, 1, 1), None]),
+    (pd.to_datetime(["2020-01-01 10:30"]), "datetime64[ns]", [np.datetime64("2020-01-01T10:30", "ns")]),
+    (["a", "a", "b", "a"], "category", ["a", "a", "b", "a"]),
+    (["a", "b", "c"], "object", ["a", "b", "c"]),
+])
+def test_compact_column(values, dtype, expected):
+    array = compact_column(pd.Series(values))
+    assert str(array.dtype) == dtype
+    assert [None if pd.isna(value) else value for value in array] == expected
+
+
+def test_changed_sheets(tmp_path, make_workbook):
+    input_file = make_workbook({"A": [["x"], [1]], "B": [["x"], [2]]})
+    db_path = str(tmp_path / "cache.sqlite")
+    create_cache_db(input_file, db_path)
+
+    wb = openpyxl.load_workbook(input_file)
+    wb["B"]["A2"] = 3
+    wb.save(input_file)
+    with sqlite3.connect(db_path) as conn:
+        assert changed_sheets(conn, input_file) == {"B"}
+
+
+@pytest.fixture
+def numbers_db(tmp_path):
+    db_path = str(tmp_path / "numbers.sqlite")
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE t (n)")
+        conn.executemany("INSERT INTO t VALUES (?)", ((i,) for i in range(50000)))
+    return db_path
+
+
+def test_result_pager_jumps_to_any_offset(numbers_db):
+    pager = ResultPager(numbers_db, "SELECT n, '--x' FROM t -- all rows")
+    try:
+        assert pager.rows(0, 2) == [(0, "--x"), (1, "--x")]
+        assert pager.rows(40000, 2) == [(40000, "--x"), (40001, "--x")]
+        assert pager.rows(10, 1) == [(10, "--x")]
+        assert pager.rows(49999, 5) == [(49999, "--x")]
+    finally:
+        pager.close()
+
+
+def test_closing_the_pager_stops_a_running_read(numbers_db):
+    pager = ResultPager(numbers_db, "SELECT a.n FROM t a, t b")
+    errors = []
+
+    def read():
+        try:
+            pager.rows(10 ** 9, 1)  # an OFFSET this far takes minutes
+        except Exception as e:
+            errors.append(e)
+    reader = threading.Thread(target=read)
+    reader.start()
+    time.sleep(0.2)
+    started = time.monotonic()
+    pager.close()
+    assert time.monotonic() - started < 5
+    reader.join()
+    assert len(errors) == 1
+
+
+@pytest.fixture
+def workbook(tmp_path, make_workbook):
+    input_file = make_workbook({"Lookup": [["a", "b"], [1, 2, 3]], "Sales 2024": [["a", "b"], [1, 2, 3]], "Other": [["a"], [1]]})
+    workbook = Workbook(input_file, WorkbookCache(str(tmp_path / "cache")), workers=1)
+    workbook.load()
+    yield workbook
+    workbook.close()
+
+
+def test_failing_query_parses_no_sheets(workbook):
+    with pytest.raises(sqlite3.OperationalError):
+        workbook.referenced_sheets("SELEC * FROM Lookup")
+    assert workbook.pending == {"Lookup", "Sales 2024", "Other"}
+
+
+def test_unknown_column_parses_only_the_named_sheets(workbook):
+    # Brackets, an unknown column in double quotes would be taken for a string
+    assert workbook.referenced_sheets("SELECT [Unnamed: 2] FROM Sales_2024 -- Other") == {"Sales 2024"}
+    assert workbook.run("SELECT [Unnamed: 2] FROM Sales_2024", lambda cursor: cursor.fetchall()) == [(3,)]
+    assert workbook.pending == {"Lookup", "Other"}
+
+
+def test_attached_cache_is_not_evicted(tmp_path, make_workbook):
+    cache = WorkbookCache(str(tmp_path / "cache"), size_limit=1)
+    first = Workbook(make_workbook({"S": [["x"], [1]]}, "first.xlsx"), cache, workers=1)
+    second = Workbook(make_workbook({"S": [["x"], [2]]}, "second.xlsx"), cache, workers=1)
+    first.load()
+    second.load()
+    first.attach("second", second)
+    try:
+        assert first.run("SELECT * FROM S, second.S", lambda cursor: cursor.fetchall()) == [(1, 2)]
+        assert cache.in_use.keys() == {first.fingerprint["hash"], second.fingerprint["hash"]}
+    finally:
+        second.close()
+        first.close()
+    assert not cache.in_use
+
+
+@pytest.fixture
+def big_workbook(tmp_path, make_workbook):
+    input_file = make_workbook({"S": [["n", "m"]] + [[i, i % 7] for i in range(2000)]})
+    workbook = Workbook(input_file, WorkbookCache(str(tmp_path / "cache")), workers=1)
+    workbook.load()
+    yield workbook
+    workbook.close()
+
+
+def test_cancel_before_the_run_starts(big_workbook):
+    big_workbook.cancel()
+    with pytest.raises(QueryCancelled):
+        big_workbook.run("SELECT count(*) FROM S", lambda cursor: cursor.fetchall())
+    big_workbook.reset_cancel()
+    assert big_workbook.run("SELECT count(*) FROM S", lambda cursor: cursor.fetchall()) == [(2000,)]
+
+
+def test_cancelled_run_removes_its_partial_output(tmp_path, big_workbook):
+    output_file = tmp_path / "out.csv"
+    output_file.write_text("earlier result")
+    with pytest.raises(QueryCancelled):
+        big_workbook.run("SELECT * FROM S a, S b", lambda cursor: write_result(cursor, str(output_file)), on_progress=big_workbook.cancel)
+    assert output_file.read_text() == "earlier result"
+    assert list(tmp_path.glob("out.csv.*")) == []
+
+
+def test_cancelled_index_is_not_recorded(big_workbook):
+    big_workbook.ensure_sheets({"S"})
+    statements = []
+
+    def progress():
+        # Cancel pressed while the index is being built, as during automatic indexing
+        if statements[-1].startswith("CREATE INDEX"):
+            big_workbook.cancel()
+        return 0
+    big_workbook.conn.set_trace_callback(statements.append)
+    big_workbook.conn.set_progress_handler(progress, 100)
+    with pytest.raises(QueryCancelled):
+        big_workbook.create_index("S", ["m"])
+    assert big_workbook.indexes() == []
+
+
+def test_index_names_dont_collide(tmp_path, make_workbook):
+    input_file = make_workbook({"a_b": [["c"], [1]], "a": [["b", "c"], [1, 2]]})
+    workbook = Workbook(input_file, WorkbookCache(str(tmp_path / "cache")), workers=1)
+    workbook.load()
+    try:
+        first = workbook.create_index("a_b", ["c"])
+        second = workbook.create_index("a", ["b", "c"])
+        assert first != second
+        assert sorted((table, columns) for _, table, columns in workbook.indexes()) == [("a", ["b", "c"]), ("a_b", ["c"])]
+        workbook.drop_index(second)
+        assert workbook.conn.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx%'").fetchall() == \
+            [(first, "a_b")]
+    finally:
+        workbook.close()
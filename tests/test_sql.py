@@ -0,0 +1,54 @@
+#  -*- coding: utf-8 -*-
+import pytest
+from cache import is_volatile, normalize_sql
+from engine import split_script, sql_names
+
+
+def test_split_script_names_statements():
+    script = """
+        -- name: Totals
+        SELECT 1;
+        SELECT 2;
+        -- name: Text with ; inside
+        SELECT 'a;b' /* ; */ ;
+    """
+    assert [name for name, _ in split_script(script)] == ["Totals", "Query2", "Text with ; inside"]
+    assert split_script(script)[2][1].startswith("-- name: Text with ; inside")
+
+
+def test_split_script_skips_empty_statements():
+    assert split_script(";; -- only a comment\n;") == []
+    assert split_script("SELECT 1") == [("Query1", "SELECT 1")]
+
+
+def test_normalize_sql():
+    assert normalize_sql("SELECT  a, -- comment\n 'x  --y'  FROM t /* block */ ;  ") == "SELECT a, 'x  --y' FROM t"
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT random()",
+    "SELECT * FROM t WHERE d > date(CURRENT_DATE, '-7 days')",
+    "SELECT current_timestamp",
+    "SELECT date()",
+    "SELECT julianday( )",
+    "SELECT unixepoch()",
+    "SELECT strftime('%s')",
+    "SELECT datetime('NOW', 'localtime')",
+    "SELECT total_changes()",
+])
+def test_is_volatile(sql):
+    assert is_volatile(sql)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM t",
+    "SELECT date(d), strftime('%Y', d) FROM t",
+    "SELECT current_dates, updated_date() FROM t",
+])
+def test_is_not_volatile(sql):
+    assert not is_volatile(sql)
+
+
+def test_sql_names():
+    assert sql_names("SELECT \"Unnamed: 2\", [My Col] FROM Sales_2024 s -- Other\nWHERE s.x = 'Lookup'") == \
+        {"select", "unnamed: 2", "my col", "from", "sales_2024", "s", "where", "x"}
@@ -0,0 +1,61 @@
+#  -*- coding: utf-8 -*-
+import sqlite3
+import openpyxl
+import pytest
+from writers import FETCH_SIZE, result_names, script_writer, write_parquet, write_xlsx
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t (n, s)")
+    conn.executemany("INSERT INTO t VALUES (?, ?)", ((i, f"row {i}") for i in range(10)))
+    yield conn
+    conn.close()
+
+
+def test_write_xlsx_spills_onto_more_sheets(tmp_path, conn):
+    output_file = str(tmp_path / "out.xlsx")
+    assert write_xlsx(conn.execute("SELECT * FROM t"), output_file, max_rows=5) == 10
+    wb = openpyxl.load_workbook(output_file)
+    assert wb.sheetnames == ["SQLResults", "SQLResults_2", "SQLResults_3"]
+    assert [wb[name].max_row for name in wb.sheetnames] == [5, 5, 3]  # every sheet repeats the header
+    assert [len(wb[name].tables) for name in wb.sheetnames] == [1, 1, 1]
+
+
+def test_write_xlsx_table_spans_more_than_26_columns(tmp_path):
+    conn = sqlite3.connect(":memory:")
+    conn.execute(f"CREATE TABLE wide ({', '.join(f'c{i}' for i in range(30))})")
+    conn.executemany(f"INSERT INTO wide VALUES ({', '.join('?' * 30)})", [tuple(range(30))] * 3)
+    output_file = str(tmp_path / "out.xlsx")
+    assert write_xlsx(conn.execute("SELECT * FROM wide"), output_file) == 3
+
+    ws = openpyxl.load_workbook(output_file)["SQLResults"]
+    (table,) = ws.tables.values()
+    assert table.ref == "A1:AD4" == ws.dimensions
+    assert [column.name for column in table.tableColumns] == [f"c{i}" for i in range(30)]
+
+
+def test_script_writer_keeps_query_order(tmp_path, conn):
+    output_file = str(tmp_path / "out.xlsx")
+    with script_writer(output_file) as writer:
+        writer.write(1, "Second", conn.execute("SELECT n FROM t"))
+        writer.write(0, "First", conn.execute("SELECT s FROM t"))
+    assert openpyxl.load_workbook(output_file).sheetnames == ["First", "Second"]
+
+
+def test_result_names():
+    assert result_names(["Totals", "totals", "a/b", "", "x" * 40]) == ["Totals", "totals_2", "a_b", "SQLResults", "x" * 31]
+
+
+def test_write_parquet_widens_later_batches(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t (price, code, empty)")
+    conn.executemany("INSERT INTO t VALUES (?, ?, ?)", [(i, i, None) for i in range(FETCH_SIZE)] + [(2.5, "x1", None), (None, 7, 3)])
+    output_file = str(tmp_path / "out.parquet")
+    assert write_parquet(conn.execute("SELECT * FROM t"), output_file) == FETCH_SIZE + 2
+
+    table = pq.read_table(output_file)
+    assert [str(field.type) for field in table.schema] == ["double", "string", "int64"]
+    assert table.slice(FETCH_SIZE).to_pylist() == [{"price": 2.5, "code": "x1", "empty": None}, {"price": None, "code": "7", "empty": 3}]
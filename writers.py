@@ -0,0 +1,392 @@
+#  -*- coding: utf-8 -*-
+"""Writing query results straight from a SQLite cursor to the output file"""
+import csv
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import warnings
+from contextlib import contextmanager
+import openpyxl
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
+from engine import quote_identifier
+
+FETCH_SIZE = 5000
+WIDTH_SAMPLE_ROWS = 1000
+RESULT_SHEET = "SQLResults"
+RESULT_TABLE = "SQLTable"
+EXCEL_MAX_ROWS = 1048576
+EXCEL_MAX_SHEET_NAME = 31
+
+
+@contextmanager
+def partial_file(output_file):
+    """Yields a temporary path that replaces output_file once writing succeeded, and is removed if it didn't"""
+    tmp_path = f"{output_file}.part"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, output_file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def result_columns(cursor):
+    """Returns the result column names, made unique the way Excel does for table headers"""
+    if cursor.description is None:
+        raise ValueError("The query doesn't return any rows to write.")
+
+    columns = []
+    for description in cursor.description:
+        name = str(description[0])
+        suffix = 2
+        while name.lower() in (column.lower() for column in columns):
+            name = f"{description[0]}{suffix}"
+            suffix += 1
+        columns.append(name)
+    return columns
+
+
+def _batches(cursor, first=None):
+    """Yields the rows of a cursor in fetchmany sized batches, starting with rows already fetched"""
+    batch = first if first is not None else cursor.fetchmany(FETCH_SIZE)
+    while batch:
+        yield batch
+        batch = cursor.fetchmany(FETCH_SIZE)
+
+
+def _column_widths(columns, head):
+    """Returns the column widths fitting the header and the leading rows"""
+    widths = [len(column) for column in columns]
+    for row in head:
+        for i, value in enumerate(row):
+            if value is not None and len(str(value)) > widths[i]:
+                widths[i] = len(str(value))
+    return widths
+
+
+def _table_names():
+    """Yields SQLTable, SQLTable_2, ..., table names have to be unique within a workbook"""
+    yield RESULT_TABLE
+    for number in itertools.count(2):
+        yield f"{RESULT_TABLE}_{number}"
+
+
+def result_names(names):
+    """Turns query names into valid, unique sheet names: no []:*?/\\, at most 31 characters"""
+    unique = []
+    for name in names:
+        name = re.sub(r"[\[\]:*?/\\]", "_", str(name)).strip("' ")[:EXCEL_MAX_SHEET_NAME] or RESULT_SHEET
+        base, suffix = name, 2
+        while name.lower() in (other.lower() for other in unique):
+            name = f"{base[:EXCEL_MAX_SHEET_NAME - len(str(suffix)) - 1]}_{suffix}"
+            suffix += 1
+        unique.append(name)
+    return unique
+
+
+class _XlsxResult:
+    """One result in a write-only workbook, continuing on name_2, name_3, ... sheets once a sheet is full"""
+
+    def __init__(self, wb, name, columns, widths, max_rows=EXCEL_MAX_ROWS, index=None):
+        self.wb = wb
+        self.name = name
+        self.columns = columns
+        self.widths = widths
+        self.max_rows = max_rows
+        self.sheets = []  # [worksheet, rows written]
+        self.rows = 0
+        self._add_sheet(index)
+
+
+    def _add_sheet(self, index=None):
+        if self.sheets:
+            # Right after the result's last sheet, other results may follow it already
+            suffix = f"_{len(self.sheets) + 1}"
+            title = self.name[:EXCEL_MAX_SHEET_NAME - len(suffix)] + suffix
+            index = self.wb.sheetnames.index(self.sheets[-1][0].title) + 1
+        else:
+            title = self.name
+        ws = self.wb.create_sheet(title, index)
+        for i, width in enumerate(self.widths, 1):
+            ws.column_dimensions[get_column_letter(i)].width = width + 2
+        ws.append(self.columns)
+        self.sheets.append([ws, 0])
+
+
+    def append(self, batch):
+        for row in batch:
+            if self.sheets[-1][1] == self.max_rows - 1:  # the header takes a row too
+                self._add_sheet()
+            self.sheets[-1][0].append(row)
+            self.sheets[-1][1] += 1
+        self.rows += len(batch)
+
+
+    def add_tables(self, table_names):
+        """Formats every sheet of the result as a table, named from the table_names iterator"""
+        # The tables need their columns spelled out, a write-only sheet can't be read back for the header
+        for ws, sheet_rows in self.sheets:
+            table = Table(displayName=next(table_names), ref=f"A1:{get_column_letter(len(self.columns))}{max(sheet_rows, 1) + 1}")
+            table.tableColumns = [TableColumn(id=i, name=column) for i, column in enumerate(self.columns, 1)]
+            table.tableStyleInfo = TableStyleInfo(name="TableStyleMedium2", showFirstColumn=False, showLastColumn=False, showRowStripes=True, showColumnStripes=False)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)  # openpyxl always warns about the manual columns done above
+                ws.add_table(table)
+
+
+def write_xlsx(cursor, output_file, max_rows=EXCEL_MAX_ROWS):
+    """Streams a result set into a write-only workbook as formatted tables, returns the number of rows
+
+    Results longer than a sheet continue on SQLResults_2, SQLResults_3, ...
+    """
+    columns = result_columns(cursor)
+    wb = openpyxl.Workbook(write_only=True)
+
+    # Column widths have to be set before the first row is written, so they come from the leading rows
+    head = cursor.fetchmany(WIDTH_SAMPLE_ROWS)
+    result = _XlsxResult(wb, RESULT_SHEET, columns, _column_widths(columns, head), max_rows)
+    for batch in _batches(cursor, head):
+        result.append(batch)
+    result.add_tables(_table_names())
+
+    # Only replace the output file once the whole result is written
+    with partial_file(output_file) as tmp_path:
+        wb.save(tmp_path)
+    return result.rows
+
+
+def write_csv(cursor, output_file):
+    """Streams a result set into a CSV file, returns the number of rows"""
+    columns = result_columns(cursor)
+    rows = 0
+    with partial_file(output_file) as tmp_path:
+        # utf-8-sig so Excel detects the encoding when opening the file
+        with open(tmp_path, 'w', newline='', encoding='utf-8-sig') as file:
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            for batch in _batches(cursor):
+                writer.writerows(batch)
+                rows += len(batch)
+    return rows
+
+
+def _arrow_type(pa, values):
+    """Picks a Parquet column type for the values of a batch, null if they are all None"""
+    types = {type(value) for value in values if value is not None}
+    if not types:
+        return pa.null()
+    if types == {int}:
+        return pa.int64()
+    if types <= {int, float}:
+        return pa.float64()
+    if types == {bytes}:
+        return pa.binary()
+    return pa.string()
+
+
+def _wider_type(pa, current, new):
+    """Returns the type that holds the values of both column types, integers widen to floats and anything else to strings"""
+    if new == current or new == pa.null():
+        return current
+    if current == pa.null():
+        return new
+    if {current, new} == {pa.int64(), pa.float64()}:
+        return pa.float64()
+    return pa.string()
+
+
+def write_parquet(cursor, output_file):
+    """Streams a result set into a Parquet file one row group per batch, returns the number of rows"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Writing Parquet files needs pyarrow, install it with 'pip install pyarrow'.") from None
+
+    columns = result_columns(cursor)
+    schema = pa.schema([(column, pa.null()) for column in columns])
+
+    rows = 0
+    with partial_file(output_file) as tmp_path:
+        writer = None
+        try:
+            for batch in _batches(cursor):
+                values = [[row[i] for row in batch] for i in range(len(columns))]
+                # SQLite columns have no fixed type, a batch that doesn't fit the types so far widens them
+                wider = pa.schema([(field.name, _wider_type(pa, field.type, _arrow_type(pa, column_values)))
+                                   for field, column_values in zip(schema, values)])
+                if not wider.equals(schema):
+                    written = None
+                    if writer is not None:
+                        # Parquet files have one schema, the row groups written so far are rewritten with the wider types
+                        writer.close()
+                        writer = None
+                        try:
+                            written = pq.read_table(tmp_path).cast(wider)
+                        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                            raise ValueError("The result mixes value types, CAST its columns in the query to write Parquet.") from None
+                    schema = wider
+                    writer = pq.ParquetWriter(tmp_path, schema)
+                    if written is not None:
+                        writer.write_table(written)
+
+                arrays = []
+                for field, column_values in zip(schema, values):
+                    if field.type == pa.string():
+                        column_values = [value if value is None or type(value) is str else str(value) for value in column_values]
+                    try:
+                        arrays.append(pa.array(column_values, type=field.type))
+                    except (pa.ArrowInvalid, pa.ArrowTypeError):
+                        raise ValueError(f"Column '{field.name}' mixes value types, CAST it in the query to write Parquet.") from None
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                rows += len(batch)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, schema)
+        finally:
+            if writer is not None:
+                writer.close()
+    return rows
+
+
+def write_sqlite(cursor, output_file):
+    """Streams a result set into a table of a new SQLite database, returns the number of rows"""
+    columns = result_columns(cursor)
+    rows = 0
+    with partial_file(output_file) as tmp_path:
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("PRAGMA journal_mode = OFF")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute(f"CREATE TABLE {RESULT_SHEET} ({', '.join(map(quote_identifier, columns))})")
+            insert = f"INSERT INTO {RESULT_SHEET} VALUES ({', '.join('?' * len(columns))})"
+            for batch in _batches(cursor):
+                conn.executemany(insert, batch)
+                rows += len(batch)
+            conn.commit()
+        finally:
+            conn.close()
+    return rows
+
+
+# Output writers by file extension, .xlsx is the default
+OUTPUT_FORMATS = {
+    ".xlsx": write_xlsx,
+    ".csv": write_csv,
+    ".parquet": write_parquet,
+    ".sqlite": write_sqlite,
+    ".db": write_sqlite,
+}
+
+
+class XlsxResults:
+    """Writes the results of several queries into one workbook, one sheet per query, from several threads
+
+    Queries are fetched in parallel, only adding rows to the workbook takes turns. The sheets are in
+    the order of the positions, whichever query finishes first.
+    """
+
+    def __init__(self, path, max_rows=EXCEL_MAX_ROWS):
+        self.path = path
+        self.max_rows = max_rows
+        self.wb = openpyxl.Workbook(write_only=True)
+        self.lock = threading.Lock()
+        self.results = {}  # position: _XlsxResult
+        self.table_names = _table_names()
+
+
+    def write(self, position, name, cursor, on_rows=None):
+        """Writes a result to the sheet name, on_rows is called with the rows written so far, returns the number of rows"""
+        columns = result_columns(cursor)
+        head = cursor.fetchmany(WIDTH_SAMPLE_ROWS)
+        widths = _column_widths(columns, head)
+        with self.lock:
+            index = sum(len(result.sheets) for other, result in self.results.items() if other < position)
+            result = self.results[position] = _XlsxResult(self.wb, name, columns, widths, self.max_rows, index)
+        for batch in _batches(cursor, head):
+            with self.lock:
+                result.append(batch)
+            if on_rows:
+                on_rows(result.rows)
+        with self.lock:
+            result.add_tables(self.table_names)
+        return result.rows
+
+
+    def save(self):
+        self.wb.save(self.path)
+
+
+    def close(self):
+        # Sheets of a workbook that wasn't saved still have their rows writer open
+        for ws in self.wb.worksheets:
+            if not ws.closed:
+                ws.close()
+
+
+class SqliteResults:
+    """Writes the results of several queries into one SQLite database, one table per query, from several threads"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.lock = threading.Lock()
+
+
+    def write(self, position, name, cursor, on_rows=None):
+        """Writes a result to the table name, on_rows is called with the rows written so far, returns the number of rows"""
+        columns = result_columns(cursor)
+        insert = f"INSERT INTO {quote_identifier(name)} VALUES ({', '.join('?' * len(columns))})"
+        with self.lock:
+            self.conn.execute(f"CREATE TABLE {quote_identifier(name)} ({', '.join(map(quote_identifier, columns))})")
+        rows = 0
+        for batch in _batches(cursor):
+            with self.lock:
+                self.conn.executemany(insert, batch)
+            rows += len(batch)
+            if on_rows:
+                on_rows(rows)
+        return rows
+
+
+    def save(self):
+        self.conn.commit()
+
+
+    def close(self):
+        self.conn.close()
+
+
+# Writers for the results of several queries by file extension
+SCRIPT_OUTPUT_FORMATS = {
+    ".xlsx": XlsxResults,
+    ".sqlite": SqliteResults,
+    ".db": SqliteResults,
+}
+
+
+@contextmanager
+def script_writer(output_file):
+    """Yields a writer for the results of several queries, output_file is only replaced once all of them are written"""
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension not in SCRIPT_OUTPUT_FORMATS:
+        raise ValueError(f"Several queries can only be written to one file as {' or '.join(SCRIPT_OUTPUT_FORMATS)}, not '{extension}'")
+    with partial_file(output_file) as tmp_path:
+        writer = SCRIPT_OUTPUT_FORMATS[extension](tmp_path)
+        try:
+            yield writer
+            writer.save()
+        finally:
+            writer.close()
+
+
+def write_result(cursor, output_file):
+    """Writes a result set in the format matching the output file's extension, returns the number of rows"""
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format '{extension}', use one of: {', '.join(OUTPUT_FORMATS)}")
+    return OUTPUT_FORMATS[extension](cursor, output_file)